@@ -0,0 +1,70 @@
+"""Per-extraction overhead of fresh vs warm yt-dlp instances.
+
+Without arguments this times only the local setup every extraction pays
+(building a YoutubeDL from options and initializing the YouTube
+extractor), which is what reusing instances saves:
+
+    python benchmarks/bench_extractor.py --iterations 200
+
+With --url it also runs full extractions against the network:
+
+    python benchmarks/bench_extractor.py --url https://youtu.be/dQw4w9WgXcQ --iterations 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp
+
+from bot.audio import extractor
+
+
+def fresh_setup():
+    with yt_dlp.YoutubeDL(dict(extractor.YDL_OPTIONS)) as ydl:
+        ydl.get_info_extractor('Youtube')
+
+
+def warm_setup():
+    extractor._youtube_dl(None).get_info_extractor('Youtube')
+
+
+def fresh_extract(url):
+    with yt_dlp.YoutubeDL(dict(extractor.YDL_OPTIONS)) as ydl:
+        ydl.extract_info(url, download=False)
+
+
+def warm_extract(url):
+    extractor.extract_youtube_info(url)
+
+
+def timed(label, func, iterations, *args):
+    func(*args)  # Imports and first-use work shouldn't count
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - started) * 1000)
+    print(f"{label:<16} mean {statistics.mean(samples):8.3f} ms   "
+          f"median {statistics.median(samples):8.3f} ms   min {min(samples):8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--url', help="also time full extractions of this link")
+    args = parser.parse_args()
+
+    timed('fresh setup', fresh_setup, args.iterations)
+    timed('warm setup', warm_setup, args.iterations)
+    if args.url:
+        timed('fresh extract', fresh_extract, args.iterations, args.url)
+        timed('warm extract', warm_extract, args.iterations, args.url)
+    print(f"YoutubeDL instances created by the warm path: {extractor.extractors_created}")
+
+
+if __name__ == '__main__':
+    main()
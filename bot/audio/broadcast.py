@@ -0,0 +1,146 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+
+class SharedStream:
+    """One upstream audio source whose frames are fanned out to many listeners.
+
+    Frames go into a ring buffer of ``capacity`` frames (20 ms each). The
+    listener furthest ahead pulls the next frame from upstream when it
+    runs out, so the stream advances in real time as long as anyone is
+    listening. A listener that falls more than a buffer behind skips
+    ahead to the oldest frame still buffered instead of holding the
+    others back.
+    """
+
+    def __init__(self, key: str, source: discord.AudioSource, capacity: int = 250):
+        self.key = key
+        self.source = source
+        self.capacity = capacity
+        self._frames: List[Optional[bytes]] = [None] * capacity
+        self._head = 0  # Sequence number of the next frame to be read from upstream
+        self._lock = threading.Lock()  # Guards the ring buffer
+        self._upstream_lock = threading.Lock()  # One upstream read at a time
+        self.finished = False
+        self.listeners = 0
+        self.frames_skipped = 0
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def frame(self, position: int):
+        """The frame at ``position`` and the position after it.
+
+        Returns b'' once the upstream has ended and every frame up to it
+        has been read.
+        """
+        with self._lock:
+            position = self._clamp(position)
+            if position < self._head:
+                return self._frames[position % self.capacity], position + 1
+        with self._upstream_lock:
+            with self._lock:
+                position = self._clamp(position)
+                if position < self._head:
+                    # Another listener fetched it while we waited
+                    return self._frames[position % self.capacity], position + 1
+                if self.finished:
+                    return b'', position
+            data = self.source.read()
+            with self._lock:
+                if not data:
+                    self.finished = True
+                    return b'', position
+                self._frames[self._head % self.capacity] = data
+                self._head += 1
+                return data, self._head
+
+    def _clamp(self, position: int) -> int:
+        oldest = self._head - self.capacity
+        if position < oldest:
+            self.frames_skipped += oldest - position
+            return oldest
+        return position
+
+    @property
+    def head(self) -> int:
+        return self._head
+
+    def close(self):
+        self.source.cleanup()
+
+
+class SharedStreamListener(discord.AudioSource):
+    """A voice client's view of a SharedStream, joining at its live edge"""
+
+    def __init__(self, hub: 'BroadcastHub', stream: SharedStream):
+        self._hub = hub
+        self._stream = stream
+        self._position = stream.head
+        self._closed = False
+
+    def read(self) -> bytes:
+        data, self._position = self._stream.frame(self._position)
+        return data
+
+    def is_opus(self) -> bool:
+        return self._stream.is_opus()
+
+    def cleanup(self):
+        # discord.py calls this when playback stops; it drops our reference
+        if not self._closed:
+            self._closed = True
+            self._hub.release(self._stream)
+
+
+class BroadcastHub:
+    """Registry of shared streams, reference-counted by listener.
+
+    ``listen`` joins the stream for a URL, starting its pipeline if nobody
+    is playing it yet; the pipeline is shut down when the last listener's
+    source is cleaned up.
+    """
+
+    def __init__(self, capacity: int = 250):
+        self.capacity = capacity
+        self._streams: Dict[str, SharedStream] = {}
+        self._lock = threading.Lock()
+        self.streams_started = 0
+        self._closed_skips = 0  # Frames skipped by streams that have shut down
+
+    def listen(self, key: str, open_source: Callable[[], discord.AudioSource]) -> SharedStreamListener:
+        """A new listener for ``key``; ``open_source`` creates the upstream if needed"""
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None or stream.finished:
+                stream = self._streams[key] = SharedStream(key, open_source(), self.capacity)
+                self.streams_started += 1
+            stream.listeners += 1
+            return SharedStreamListener(self, stream)
+
+    def release(self, stream: SharedStream):
+        with self._lock:
+            stream.listeners -= 1
+            if stream.listeners > 0:
+                return
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+            self._closed_skips += stream.frames_skipped
+        try:
+            stream.close()
+        except Exception as e:
+            logger.error(f"Error closing shared stream {stream.key}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'streams': len(self._streams),
+                'streams_started': self.streams_started,
+                'listeners': sum(stream.listeners for stream in self._streams.values()),
+                'frames_skipped': self._closed_skips + sum(stream.frames_skipped for stream in self._streams.values()),
+            }
@@ -0,0 +1,367 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+YDL_OPTIONS = {
+    'format': 'bestaudio/best',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'error',
+    'source_address': '0.0.0.0',
+    'prefer_ffmpeg': True,
+    'keepvideo': False,
+    'audioquality': '0',  # Best quality
+    'audioformat': 'mp3',
+}
+
+
+# Each worker thread keeps one YoutubeDL and replaces it after this many
+# extractions (or any error), so its caches can't grow or go bad forever
+EXTRACTOR_MAX_USES = 100
+
+_worker = threading.local()
+extractors_created = 0
+
+
+def _youtube_dl(socket_timeout: Optional[float]) -> 'yt_dlp.YoutubeDL':
+    """This thread's warm YoutubeDL, created on first use or after recycling"""
+    global extractors_created
+    ydl = getattr(_worker, 'ydl', None)
+    if ydl is not None and (_worker.uses >= EXTRACTOR_MAX_USES or _worker.socket_timeout != socket_timeout):
+        _discard_youtube_dl()
+        ydl = None
+    if ydl is None:
+        ydl_opts = dict(YDL_OPTIONS)
+        if socket_timeout:
+            ydl_opts['socket_timeout'] = socket_timeout
+        ydl = _worker.ydl = yt_dlp.YoutubeDL(ydl_opts)
+        _worker.uses = 0
+        _worker.socket_timeout = socket_timeout
+        extractors_created += 1
+    _worker.uses += 1
+    return ydl
+
+
+def _discard_youtube_dl():
+    ydl = getattr(_worker, 'ydl', None)
+    _worker.ydl = None
+    if ydl is not None:
+        try:
+            ydl.close()
+        except Exception:
+            pass
+
+
+def extract_youtube_info(url: str, socket_timeout: Optional[float] = None) -> Optional[Dict]:
+    """Extract audio URL and metadata from a YouTube link (blocking)"""
+    try:
+        info = _youtube_dl(socket_timeout).extract_info(url, download=False)
+
+        # Get the best audio format URL
+        audio_url = None
+        if 'url' in info:
+            audio_url = info['url']
+        elif 'entries' in info and info['entries']:
+            audio_url = info['entries'][0]['url']
+
+        return {
+            'id': info.get('id', 'unknown'),
+            'title': info.get('title', 'Unknown YouTube Track'),
+            'artist': info.get('uploader', 'Unknown Uploader'),
+            'album': 'YouTube',
+            'url': audio_url,
+            'duration': str(info.get('duration', 0)),
+            'thumbnail': info.get('thumbnail', '')
+        }
+    except Exception as e:
+        logger.error(f"Error extracting YouTube info: {e}")
+        _discard_youtube_dl()  # Start the next extraction from a clean instance
+        return None
+
+
+_VIDEO_ID_RE = re.compile(r'(?:v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})')
+
+
+def video_id(url: str) -> Optional[str]:
+    """The 11-character YouTube video id in a link, if there is one"""
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
+class StreamCache:
+    """Process-wide cache of extraction results, keyed by video id.
+
+    Resolved stream URLs are signed and stop working at the time in their
+    ``expire`` query parameter, so each entry lives until shortly before
+    that. With a ``path`` the cache is loaded at startup and written back
+    periodically, so a restart doesn't have to re-extract everything.
+    """
+
+    MAX_ENTRIES = 2048
+    # Used when a stream URL carries no expiry
+    DEFAULT_TTL = 30 * 60
+    # Stop handing out URLs this long before they expire, so a track can
+    # still be streamed to the end
+    EXPIRY_MARGIN = 10 * 60
+    SAVE_INTERVAL = 60
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()  # key -> (expires_at, info)
+        self._last_save = time.time()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def _expiry(self, info: Dict) -> float:
+        """Wall-clock time after which a result should not be served"""
+        expire = parse_qs(urlparse(info.get('url') or '').query).get('expire')
+        try:
+            expires_at = float(expire[0])
+        except (TypeError, ValueError):
+            return time.time() + self.DEFAULT_TTL
+        return expires_at - self.EXPIRY_MARGIN
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, key: str, info: Dict):
+        expires_at = self._expiry(info)
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, dict(info))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def save_due(self) -> bool:
+        """True at most once per SAVE_INTERVAL while there are unsaved entries"""
+        with self._lock:
+            now = time.time()
+            if not self.path or not self._dirty or now - self._last_save <= self.SAVE_INTERVAL:
+                return False
+            self._last_save = now
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Read persisted entries, skipping ones that have expired"""
+        try:
+            with open(self.path) as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading stream cache: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, expires_at, info in rows:
+                if expires_at > now:
+                    self._entries[key] = (expires_at, info)
+
+    def save(self):
+        """Write live entries to ``path`` atomically"""
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            rows = [[key, expires_at, info] for key, (expires_at, info) in self._entries.items() if expires_at > now]
+            self._dirty = False
+            self._last_save = now
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(rows, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Error saving stream cache: {e}")
+
+    def close(self):
+        if self._dirty:
+            self.save()
+
+
+class ExtractionPool:
+    """Runs yt-dlp extractions on worker threads, off the event loop.
+
+    At most ``max_workers`` extractions run at once across all guilds.
+    Waiting requests are queued per guild and slots are handed out
+    round-robin between guilds, so one guild queueing fifty links can't
+    starve the others. Callers give up after ``timeout`` seconds; the
+    socket timeout passed to yt-dlp makes the worker itself finish soon
+    after, and only then is its slot released.
+
+    Results are shared through a StreamCache, and concurrent requests for
+    the same video wait on a single extraction.
+    """
+
+    # Recent latencies kept for the stats percentiles
+    LATENCY_SAMPLES = 256
+
+    def __init__(self, max_workers: int = 4, timeout: float = 30.0, cache: Optional[StreamCache] = None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.cache = cache if cache is not None else StreamCache()
+        self._flights: Dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='extract')
+        self._waiting: 'OrderedDict[Any, Deque[asyncio.Future]]' = OrderedDict()
+        self._active = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self._latencies: Deque[float] = deque(maxlen=self.LATENCY_SAMPLES)
+        self._waits: Deque[float] = deque(maxlen=self.LATENCY_SAMPLES)
+
+    @property
+    def queue_depth(self) -> int:
+        """Requests waiting for a worker"""
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def extract(self, url: str, guild_id=None) -> Optional[Dict]:
+        """Extract a YouTube link; None on failure or timeout"""
+        key = video_id(url) or url
+        info = self.cache.get(key)
+        if info is not None:
+            return info
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(self._extract(url, guild_id, key))
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            self.coalesced += 1
+        # Shielded so one caller giving up doesn't cancel the others' flight
+        info = await asyncio.shield(flight)
+        return dict(info) if info is not None else None
+
+    async def _extract(self, url: str, guild_id, key: str) -> Optional[Dict]:
+        queued = time.monotonic()
+        await self._acquire(guild_id)
+        started = time.monotonic()
+        self._waits.append(started - queued)
+
+        loop = asyncio.get_running_loop()
+        work = loop.run_in_executor(self._executor, extract_youtube_info, url, self.timeout)
+        # The slot stays taken until the worker really finishes
+        work.add_done_callback(lambda _: self._release())
+        try:
+            info = await asyncio.wait_for(asyncio.shield(work), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.error(f"Timed out extracting {url} after {self.timeout:g}s")
+            return None
+        self._latencies.append(time.monotonic() - started)
+        if info is None:
+            self.failed += 1
+        else:
+            self.completed += 1
+            # A result without a stream URL can't be played, so don't serve it again
+            if info.get('url'):
+                self.cache.put(key, info)
+                if self.cache.save_due():
+                    # Serializing and writing the cache must not block the event loop
+                    loop.run_in_executor(None, self.cache.save)
+        return info
+
+    async def _acquire(self, guild_id):
+        if self._active < self.max_workers and not self._waiting:
+            self._active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(guild_id, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # Granted just as we were cancelled
+            else:
+                self._discard(guild_id, waiter)
+            raise
+
+    def _discard(self, guild_id, waiter: asyncio.Future):
+        waiters = self._waiting.get(guild_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiting[guild_id]
+
+    def _release(self):
+        """Hand a finished worker's slot to the next guild in turn"""
+        while self._waiting:
+            guild_id, waiters = next(iter(self._waiting.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._waiting.move_to_end(guild_id)
+            else:
+                del self._waiting[guild_id]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @staticmethod
+    def _percentile(samples, fraction: float) -> float:
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, counters and latencies (milliseconds)"""
+        return {
+            'workers': self.max_workers,
+            'active': self._active,
+            'queue_depth': self.queue_depth,
+            'waiting_guilds': len(self._waiting),
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'latency_p50_ms': self._percentile(self._latencies, 0.5) * 1000,
+            'latency_p95_ms': self._percentile(self._latencies, 0.95) * 1000,
+            'wait_p50_ms': self._percentile(self._waits, 0.5) * 1000,
+            'wait_p95_ms': self._percentile(self._waits, 0.95) * 1000,
+            'coalesced': self.coalesced,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'cache_size': len(self.cache),
+            'extractors_created': extractors_created,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self.cache.close()
@@ -0,0 +1,71 @@
+import codecs
+import json
+from typing import Any, Iterable, Iterator, List
+
+
+class JsonArrayParser:
+    """Incremental parser for a top-level JSON array.
+
+    Feed it raw bytes as they arrive and it returns each complete element,
+    so only the unparsed tail of the document is ever held in memory.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._started = False
+        self._finished = False
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """Consume a chunk and return the elements it completed"""
+        self._buffer += self._utf8.decode(chunk)
+        return self._drain()
+
+    def close(self) -> List[Any]:
+        """Flush remaining input; raises ValueError if the array is incomplete"""
+        self._buffer += self._utf8.decode(b'', final=True)
+        items = self._drain()
+        if not self._finished:
+            raise ValueError("Truncated JSON array")
+        return items
+
+    def _drain(self) -> List[Any]:
+        items = []
+        buffer = self._buffer
+        pos = 0
+        length = len(buffer)
+        while not self._finished:
+            # Skip whitespace and element separators
+            while pos < length and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= length:
+                break
+            if not self._started:
+                if buffer[pos] != '[':
+                    raise ValueError("Expected a JSON array")
+                self._started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                self._finished = True
+                pos += 1
+                break
+            try:
+                item, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # Element continues in the next chunk
+            if not isinstance(item, (dict, list, str)) and (end == length or buffer[end] not in ' \t\r\n,]'):
+                break  # A bare number may still be growing
+            items.append(item)
+            pos = end
+        self._buffer = buffer[pos:]
+        return items
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """Yield the elements of a JSON array from an iterable of byte chunks"""
+    parser = JsonArrayParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
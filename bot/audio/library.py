@@ -1,94 +1,554 @@
 import json
+import asyncio
+import aiohttp
 import requests
 import os
-from typing import List, Dict, Optional
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Any, Iterable, List, Dict, NamedTuple, Optional, Tuple
+
+from bot.audio.json_stream import JsonArrayParser
+from bot.audio.search_index import SearchIndex
+from bot.audio.snapshot import SnapshotError, read_snapshot, write_snapshot
+from bot.audio.track import Track
+
+class _LibraryState(NamedTuple):
+    """Tracks and their indexes, always swapped in together"""
+    tracks: List[Track]
+    index: SearchIndex
+    tracks_by_id: Dict[str, Track]
+
+class _StreamingLoad:
+    """Builds a library state from a JSON track array as it streams in
+    
+    On a cold start the state is published immediately so tracks become
+    searchable as they arrive; otherwise it stays private until committed.
+    """
+    def __init__(self, library: 'MusicLibrary'):
+        self._library = library
+        self._parser = JsonArrayParser()
+        self._previous = library._state
+        self.state = _LibraryState([], SearchIndex(), {})
+        self.live = not self._previous.tracks
+        self.committed = False
+        if self.live:
+            library.loading = True
+            library._publish(self.state)
+    
+    def feed(self, chunk: bytes):
+        """Parse and index the tracks completed by a chunk"""
+        self._add(self._parser.feed(chunk))
+    
+    def finish(self) -> _LibraryState:
+        """Index any remaining tracks and return the finished state"""
+        self._add(self._parser.close())
+        return self.state
+    
+    def abort(self):
+        """Withdraw a partially published state"""
+        if self.committed:
+            return  # Already swapped in for good
+        if self.live and self._library._state is self.state:
+            self._library._publish(self._previous)
+        self._library.loading = False
+    
+    def _add(self, tracks: List[Dict]):
+        if not tracks:
+            return
+        state = self.state
+        # Readers may be searching the live index, so add in locked batches
+        with self._library._lock if self.live else nullcontext():
+            for data in tracks:
+                track = Track.from_data(data)
+                state.tracks.append(track)
+                state.index.add(track)
+                state.tracks_by_id.setdefault(track.get('id'), track)
 
 class MusicLibrary:
-    def __init__(self, server_url):
+    # Rebuild the search index from scratch once this share of it is dead
+    MAX_INDEX_FRAGMENTATION = 0.25
+    # Read size for streamed library payloads
+    CHUNK_SIZE = 256 * 1024
+    # Number of distinct queries whose ranked results are cached
+    QUERY_CACHE_SIZE = 512
+    # Fields the library can be listed by
+    SORT_FIELDS = ('title', 'artist', 'album', 'year', 'duration')
+    # Binary copy of the library and its indexes for fast cold starts
+    SNAPSHOT_PATH = 'library.snapshot'
+    
+    def __init__(self, server_url, autoload: bool = True):
         self.server_url = server_url.rstrip('/')  # Remove trailing slash
-        self.library = []
-        self.load_library()
+        self._state = _LibraryState([], SearchIndex(), {})
+        self._lock = threading.RLock()  # Guards in-place index updates
+        self._refresh_lock = threading.Lock()  # One refresh applies at a time
+        self._etag = None
+        self._last_modified = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.loading = False  # True while a cold-start load is still streaming
+        self.generation = 0  # Bumped whenever the library contents change
+        self._query_cache: OrderedDict = OrderedDict()  # (query, fuzzy, limit) -> track ids
+        self._query_cache_generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._sort_orders: Dict[str, List[Track]] = {}  # Valid for _sort_generation
+        self._sort_generation = 0
+        if autoload:
+            self.load_library()
+    
+    @property
+    def library(self) -> List[Track]:
+        return self._state.tracks
+    
+    def _publish(self, state: _LibraryState):
+        """Make a library state current and invalidate cached query results"""
+        with self._lock:
+            self._state = state
+            self.generation += 1
     
     def load_library(self):
         """Load library from server API or JSON file"""
         try:
             # Option 1: Fetch from server API endpoint
             api_url = f"{self.server_url}/api/music"
-            response = requests.get(api_url, timeout=10)
-            if response.status_code == 200:
-                self.library = response.json()
-                return
-            
-            # Option 2: Load from local JSON file (fallback)
+            with requests.get(api_url, timeout=10, stream=True) as response:
+                if response.status_code == 200:
+                    self._ingest(response.iter_content(self.CHUNK_SIZE), response.headers)
+                    return
+        except Exception as e:
+            print(f"Error loading library: {e}")
+        
+        # Option 2: Load from local JSON file (fallback)
+        self.load_local_library()
+    
+    def load_local_library(self):
+        """Load library from the local snapshot or JSON file without touching the network"""
+        if self._snapshot_is_current() and self.load_snapshot():
+            return
+        try:
             if os.path.exists('library.json'):
-                with open('library.json', 'r') as f:
-                    self.library = json.load(f)
+                with open('library.json', 'rb') as f:
+                    self._ingest(iter(lambda: f.read(self.CHUNK_SIZE), b''))
             else:
                 # Create empty library
-                self.library = []
-                self.save_library()
-                
+                self._set_library([])
+                with self._refresh_lock:
+                    self.save_library()
         except Exception as e:
-            print(f"Error loading library: {e}")
-            self.library = []
+            print(f"Error loading local library: {e}")
+            self._set_library([])
+    
+    def _ingest(self, chunks: Iterable[bytes], headers=None, save: bool = False):
+        """Stream a JSON track array into the library, one track at a time"""
+        load = _StreamingLoad(self)
+        try:
+            for chunk in chunks:
+                load.feed(chunk)
+            self._commit_load(load, headers, save)
+        except BaseException:
+            load.abort()
+            raise
+    
+    def _commit_load(self, load: _StreamingLoad, headers=None, save: bool = False) -> bool:
+        """Swap in a finished streaming load
+        
+        Nothing after the swap may raise: the caller would abort the load
+        and put the previous library back under the new validators.
+        """
+        state = load.finish()
+        with self._refresh_lock:
+            self.loading = False
+            self._publish(state)
+            load.committed = True
+            if headers is not None:
+                self._remember_validators(headers)
+            if save:
+                self.save_library()
+        return True
+    
+    def _set_library(self, tracks: List[Dict]):
+        """Replace the library, building its indexes before swapping them in"""
+        tracks = [Track.from_data(track) for track in tracks]
+        index = SearchIndex.build(tracks)
+        tracks_by_id = {}
+        for track in tracks:
+            # Keep the first track for duplicate ids, like a linear scan would
+            tracks_by_id.setdefault(track.get('id'), track)
+        self._publish(_LibraryState(tracks, index, tracks_by_id))
     
     def save_library(self):
-        """Save library to local file"""
-        with open('library.json', 'w') as f:
-            json.dump(self.library, f, indent=2)
+        """Save library to local file atomically; call with ``_refresh_lock`` held
+        
+        The library in memory is already current, so a failed write is
+        logged rather than raised: the next refresh or restart retries it.
+        """
+        tmp_path = 'library.json.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.library, f, separators=(',', ':'), default=Track.to_dict)
+            os.replace(tmp_path, 'library.json')
+        except OSError as e:
+            print(f"Error saving library: {e}")
+            return
+        self.save_snapshot()
+    
+    def save_snapshot(self):
+        """Write the binary snapshot used for fast cold starts
+        
+        Called with ``_refresh_lock`` held, which is all that changes the
+        index in place, so searches go on while the file is written.
+        """
+        state = self._state
+        meta = {'etag': self._etag, 'last_modified': self._last_modified}
+        try:
+            write_snapshot(self.SNAPSHOT_PATH, state.tracks, state.index, meta)
+        except OSError as e:
+            print(f"Error saving library snapshot: {e}")
+    
+    def _snapshot_is_current(self) -> bool:
+        """True if the snapshot exists and is not older than library.json"""
+        try:
+            snapshot_mtime = os.path.getmtime(self.SNAPSHOT_PATH)
+        except OSError:
+            return False
+        try:
+            return snapshot_mtime >= os.path.getmtime('library.json')
+        except OSError:
+            return True
+    
+    def load_snapshot(self) -> bool:
+        """Load the library and its prebuilt indexes from the binary snapshot"""
+        try:
+            tracks, index, meta = read_snapshot(self.SNAPSHOT_PATH)
+        except SnapshotError as e:
+            print(f"Error loading library snapshot: {e}")
+            return False
+        if index is None:
+            index = SearchIndex.build(tracks)
+        tracks_by_id = {}
+        for track in tracks:
+            tracks_by_id.setdefault(track.get('id'), track)
+        with self._refresh_lock:
+            self._publish(_LibraryState(tracks, index, tracks_by_id))
+            # Lets the first refresh be a conditional or delta request
+            self._etag = meta.get('etag')
+            self._last_modified = meta.get('last_modified')
+        return True
+    
+    def _remember_validators(self, headers):
+        """Keep the cache validators of the last full payload"""
+        self._etag = headers.get('ETag')
+        self._last_modified = headers.get('Last-Modified')
+    
+    def _conditional_headers(self) -> Dict[str, str]:
+        """Request headers that let the server answer 304 Not Modified"""
+        headers = {}
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+        return headers
     
     def refresh_library(self):
-        """Refresh library from server"""
+        """Refresh library from server
+        
+        Asks for a delta against the last seen version first, then falls back
+        to a conditional full fetch. Returns True when the library is up to
+        date, whether or not anything changed.
+        """
         try:
+            if self._etag:
+                delta_url = f"{self.server_url}/api/music/delta"
+                response = requests.get(delta_url, params={'since': self._etag},
+                                        headers=self._conditional_headers(), timeout=10)
+                applied = self._apply_delta_response(response.status_code, response.headers, response.content)
+                if applied is not None:
+                    return applied
+                # Unknown base version or no delta support: fetch everything
+            
             api_url = f"{self.server_url}/api/music"
-            response = requests.get(api_url, timeout=10)
-            if response.status_code == 200:
-                self.library = response.json()
-                self.save_library()
-                return True
+            with requests.get(api_url, headers=self._conditional_headers(), timeout=10, stream=True) as response:
+                if response.status_code == 304:
+                    return True
+                if response.status_code == 200:
+                    self._ingest(response.iter_content(self.CHUNK_SIZE), response.headers, save=True)
+                    return True
         except Exception as e:
             print(f"Error refreshing library: {e}")
         return False
     
-    def search(self, query: str) -> List[Dict]:
-        """Search through library with improved matching"""
-        results = []
-        query = query.lower().strip()
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Pooled HTTP session shared by all async refreshes"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=60, sock_connect=10),
+            )
+        return self._session
+    
+    async def refresh_library_async(self) -> bool:
+        """Refresh library from server without blocking the event loop
         
-        if not query:
-            return self.library[:20]  # Return first 20 if no query
+        Network I/O runs on the pooled session; the payload is parsed and
+        indexed chunk by chunk in a worker thread, and the finished library
+        is swapped in at once.
+        """
+        try:
+            session = await self._get_session()
+            if self._etag:
+                delta_url = f"{self.server_url}/api/music/delta"
+                async with session.get(delta_url, params={'since': self._etag},
+                                       headers=self._conditional_headers()) as response:
+                    body = await response.read()
+                    applied = await asyncio.to_thread(
+                        self._apply_delta_response, response.status, response.headers, body)
+                if applied is not None:
+                    return applied
             
-        for track in self.library:
-            # Check multiple fields for matches
-            searchable_text = f"{track.get('title', '')} {track.get('artist', '')} {track.get('album', '')}".lower()
-            if query in searchable_text:
-                results.append(track)
-                
-        # Sort by relevance (simplified)
-        results.sort(key=lambda x: self._calculate_relevance(x, query), reverse=True)
-        return results[:15]  # Return top 15 matches
-    
-    def _calculate_relevance(self, track: Dict, query: str) -> int:
-        """Calculate how relevant a track is to the query"""
-        score = 0
-        searchable_text = f"{track.get('title', '')} {track.get('artist', '')} {track.get('album', '')}".lower()
+            api_url = f"{self.server_url}/api/music"
+            async with session.get(api_url, headers=self._conditional_headers()) as response:
+                if response.status == 304:
+                    return True
+                if response.status != 200:
+                    return False
+                load = _StreamingLoad(self)
+                try:
+                    async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                        await asyncio.to_thread(load.feed, chunk)
+                    return await asyncio.to_thread(self._commit_load, load, response.headers, True)
+                except BaseException:
+                    load.abort()
+                    raise
+        except Exception as e:
+            print(f"Error refreshing library: {e}")
+        return False
+    
+    def start_background_refresh(self) -> asyncio.Task:
+        """Start a refresh in the background, or join the one already running"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.get_running_loop().create_task(self.refresh_library_async())
+        return self._refresh_task
+    
+    async def close(self):
+        """Close the pooled HTTP session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+    
+    def _apply_delta_response(self, status: int, headers, body: bytes) -> Optional[bool]:
+        """Apply a /api/music/delta payload; None means a full fetch is needed"""
+        if status == 304:
+            return True
+        if status != 200:
+            return None
+        delta = json.loads(body)
+        with self._refresh_lock:
+            if self._apply_delta(delta.get('changed', []), delta.get('removed', [])):
+                self.save_library()
+            self._etag = delta.get('etag') or headers.get('ETag')
+            self._last_modified = headers.get('Last-Modified')
+        return True
+    
+    def _apply_delta(self, changed: List[Dict], removed: List[str]) -> bool:
+        """Apply added/changed tracks and removed ids to the live library
         
-        if query in track.get('title', '').lower():
-            score += 10
-        if query in track.get('artist', '').lower():
-            score += 8
-        if query in track.get('album', '').lower():
-            score += 5
+        The indexes are updated in place; only the track list is re-sliced.
+        Call with ``_refresh_lock`` held. Returns True if anything changed.
+        """
+        if not changed and not removed:
+            return False
+        
+        with self._lock:
+            state = self._state
+            index, tracks_by_id = state.index, state.tracks_by_id
+            replaced = {}  # id -> new track, or None when removed
+            
+            for track_id in removed:
+                if track_id in tracks_by_id:
+                    replaced[track_id] = None
+            for data in changed:
+                track = Track.from_data(data)
+                replaced[track.get('id')] = track
+            
+            for track_id, track in replaced.items():
+                docno = index.docno_by_id.get(track_id)
+                if docno is not None:
+                    index.remove(docno)
+                if track is None:
+                    tracks_by_id.pop(track_id, None)
+            
+            tracks = []
+            for track in state.tracks:
+                track_id = track.get('id')
+                if track_id in replaced:
+                    track = replaced.pop(track_id)
+                    if track is None:
+                        continue
+                    index.add(track)
+                    tracks_by_id[track_id] = track
+                tracks.append(track)
+            # Whatever is left was not in the library yet
+            for track_id, track in replaced.items():
+                if track is not None:
+                    index.add(track)
+                    tracks_by_id[track_id] = track
+                    tracks.append(track)
             
-        return score
+            self._publish(_LibraryState(tracks, index, tracks_by_id))
+        
+        if index.fragmentation > self.MAX_INDEX_FRAGMENTATION:
+            # Built outside the lock so searches carry on against the old
+            # index meanwhile; _refresh_lock keeps the tracks from changing
+            self._publish(_LibraryState(tracks, SearchIndex.build(tracks), tracks_by_id))
+        return True
+    
+    def search(self, query: str, limit: int = 15, fuzzy: Optional[bool] = None) -> List[Track]:
+        """Search through library using the token and trigram indexes
+        
+        fuzzy=False only returns exact (prefix) matches, fuzzy=True ranks by
+        trigram similarity, and the default falls back to fuzzy matching when
+        nothing matches exactly.
+        """
+        query = ' '.join(query.lower().split())
+        
+        state = self._state
+        if not query:
+            return state.tracks[:20]  # Return first 20 if no query
+        
+        with self._lock:
+            return self._search_locked(query, limit, fuzzy)
+    
+    def search_many(self, queries: Iterable[str], fuzzy: Optional[bool] = None) -> List[Optional[Track]]:
+        """Best match for each of several queries, in order (None if nothing matched)
+        
+        Repeated queries are only searched once. The lock is taken per
+        query, so searches from the event loop can slip in between those of
+        a long batch instead of waiting for all of it.
+        """
+        best: Dict[str, Optional[Track]] = {}
+        results = []
+        for query in queries:
+            query = ' '.join(query.lower().split())
+            if query not in best:
+                if query:
+                    with self._lock:
+                        matches = self._search_locked(query, 1, fuzzy)
+                else:
+                    matches = []
+                best[query] = matches[0] if matches else None
+            results.append(best[query])
+        return results
     
-    def get_track_by_id(self, track_id: str) -> Optional[Dict]:
+    def _search_locked(self, query: str, limit: int, fuzzy: Optional[bool]) -> List[Track]:
+        """Search a normalized query; the caller holds the lock"""
+        key = (query, fuzzy, limit)
+        cached = self._cached_results(key)
+        if cached is not None:
+            tracks_by_id = self._state.tracks_by_id
+            return [tracks_by_id[track_id] for track_id in cached]
+        
+        index = self._state.index
+        docnos = [] if fuzzy else index.search(query, limit)
+        if not docnos and fuzzy is not False:
+            docnos = index.fuzzy_search(query, limit)
+        results = [index.docs[docno] for docno in docnos]
+        self._cache_results(key, results)
+        return results
+    
+    def _cached_results(self, key: Tuple) -> Optional[Tuple[str, ...]]:
+        """Look up cached result ids, dropping the cache if the library changed"""
+        if self._query_cache_generation != self.generation:
+            self._query_cache.clear()
+            self._query_cache_generation = self.generation
+        ids = self._query_cache.get(key)
+        if ids is None:
+            self.cache_misses += 1
+            return None
+        self._query_cache.move_to_end(key)
+        self.cache_hits += 1
+        return ids
+    
+    def _cache_results(self, key: Tuple, results: List[Track]):
+        """Remember the ranked result ids of a query"""
+        if self.loading:
+            return  # Partial results would go stale as the load continues
+        tracks_by_id = self._state.tracks_by_id
+        ids = tuple(track.get('id') for track in results)
+        if any(tracks_by_id.get(track_id) is not track for track_id, track in zip(ids, results)):
+            return  # Tracks without unique ids can't be resolved back
+        self._query_cache[key] = ids
+        if len(self._query_cache) > self.QUERY_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Query cache counters, for sizing QUERY_CACHE_SIZE"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': self.cache_hits / lookups if lookups else 0.0,
+            'size': len(self._query_cache),
+            'capacity': self.QUERY_CACHE_SIZE,
+            'generation': self.generation,
+        }
+    
+    def get_track_by_id(self, track_id: str) -> Optional[Track]:
         """Get track by its ID"""
-        for track in self.library:
-            if track.get('id') == track_id:
-                return track
-        return None
+        return self._state.tracks_by_id.get(track_id)
     
-    def get_all_tracks(self) -> List[Dict]:
+    def get_tracks_by_ids(self, track_ids: List[str]) -> List[Track]:
+        """Get tracks for several IDs in order, skipping unknown ones"""
+        tracks_by_id = self._state.tracks_by_id
+        return [tracks_by_id[track_id] for track_id in track_ids if track_id in tracks_by_id]
+    
+    def get_all_tracks(self) -> List[Track]:
         """Get all tracks"""
-        return self.library
\ No newline at end of file
+        return self.library
+    
+    def get_sorted_tracks(self, sort_by: Optional[str] = None) -> List[Track]:
+        """All tracks ordered by a field, computed once per library generation"""
+        if sort_by is None:
+            return self.library
+        if sort_by not in self.SORT_FIELDS:
+            raise ValueError(f"Cannot sort by {sort_by!r}")
+        with self._lock:
+            if self._sort_generation != self.generation:
+                self._sort_orders = {}
+                self._sort_generation = self.generation
+            order = self._sort_orders.get(sort_by)
+            if order is not None:
+                return order
+            generation, tracks = self.generation, self.library
+        # Sorted outside the lock so searches don't wait for it
+        order = sorted(tracks, key=lambda track: self._sort_key(track, sort_by))
+        with self._lock:
+            if self._sort_generation == generation:
+                self._sort_orders.setdefault(sort_by, order)
+        return order
+    
+    @staticmethod
+    def _sort_key(track: Track, field: str):
+        """Numeric fields sort numerically, text case-insensitively; blanks last"""
+        value = track.get(field)
+        if field in ('year', 'duration'):
+            try:
+                return (0, float(value), '')
+            except (TypeError, ValueError):
+                return (1, 0.0, '')
+        if not value:
+            return (1, 0.0, '')
+        return (0, 0.0, str(value).casefold())
+    
+    def get_tracks_page(self, offset: int = 0, limit: int = 50, sort_by: Optional[str] = None,
+                        descending: bool = False) -> Tuple[List[Track], int]:
+        """One page of the (optionally sorted) library and the total track count"""
+        order = self.get_sorted_tracks(sort_by)
+        total = len(order)
+        offset = max(0, offset)
+        limit = max(0, limit)
+        if not descending:
+            return order[offset:offset + limit], total
+        # Walk the ascending order backwards without copying it
+        end = total - offset
+        start = max(0, end - limit)
+        return order[start:end][::-1] if end > 0 else [], total
\ No newline at end of file
@@ -1,97 +1,230 @@
-import json
 import os
-from typing import Dict, List, Optional
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from bot.audio.playlist_store import (JournalPlaylistStore, JsonPlaylistStore, Record, SqlitePlaylistStore,
+                                      WriteBehindStore, apply_record)
 
 class PlaylistManager:
-    def __init__(self, playlists_file: str = "playlists.json"):
+    # With a lazy backend, users idle this long are dropped from memory
+    IDLE_EVICT_SECONDS = 600
+    
+    def __init__(self, playlists_file: str = "playlists.json", backend: str = "journal",
+                 flush_interval: Optional[float] = None, library=None):
         self.playlists_file = playlists_file
+        self.library = library  # MusicLibrary used to store and resolve track references
+        if backend == "journal":
+            self.store = JournalPlaylistStore(playlists_file)
+        elif backend == "json":
+            self.store = JsonPlaylistStore(playlists_file)
+        elif backend == "sqlite":
+            db_file = os.path.splitext(playlists_file)[0] + ".db"
+            self.store = SqlitePlaylistStore(db_file, import_from=playlists_file)
+        else:
+            raise ValueError(f"Unknown playlist backend: {backend}")
+        if flush_interval is not None:
+            # Write-behind: changes reach disk within flush_interval seconds
+            self.store = WriteBehindStore(self.store, flush_interval)
+        self._last_used: Dict[str, float] = {}
+        self._last_sweep = time.monotonic()
+        self._members: Dict[Tuple[str, str], Set[str]] = {}  # Track ids per playlist
         self.playlists = self.load_playlists()
     
     def load_playlists(self) -> Dict:
-        """Load playlists from file"""
-        if os.path.exists(self.playlists_file):
-            try:
-                with open(self.playlists_file, 'r') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
+        """Load playlists from the store"""
+        return self.store.load()
     
     def save_playlists(self):
-        """Save playlists to file"""
-        with open(self.playlists_file, 'w') as f:
-            json.dump(self.playlists, f, indent=2)
+        """Write all playlists to the store in one go"""
+        self.store.save()
+    
+    def close(self):
+        """Flush and release the store"""
+        self.store.close()
+    
+    def store_stats(self) -> Dict:
+        """Persistence metrics, when the store keeps any"""
+        stats = getattr(self.store, 'stats', None)
+        return stats() if stats else {}
+    
+    def _user(self, user_id: str) -> Dict:
+        """Playlists of a user, loading them from a lazy backend if needed"""
+        with self.store.lock:
+            playlists = self.playlists.get(user_id)
+        if playlists is None and self.store.lazy:
+            # Loaded without holding the lock: a write-behind store flushes
+            # first, and mutations of other users shouldn't wait for the disk
+            loaded = self.store.load_user(user_id)
+            with self.store.lock:
+                # Another thread may have loaded (and changed) them meanwhile
+                playlists = self.playlists.setdefault(user_id, loaded)
+        if self.store.lazy:
+            with self.store.lock:
+                now = time.monotonic()
+                self._last_used[user_id] = now
+                if now - self._last_sweep > self.IDLE_EVICT_SECONDS / 10:
+                    self._evict_idle(now)
+        return playlists if playlists is not None else {}
+    
+    def _evict_idle(self, now: float):
+        """Forget users that have not been touched for a while"""
+        self._last_sweep = now
+        for user_id, last_used in list(self._last_used.items()):
+            if now - last_used > self.IDLE_EVICT_SECONDS:
+                del self._last_used[user_id]
+                for name in self.playlists.pop(user_id, {}):
+                    self._members.pop((user_id, name), None)
+    
+    def _membership(self, user_id: str, name: str, playlist: Dict) -> Set[str]:
+        """Ids of the tracks in a playlist, built on first use"""
+        members = self._members.get((user_id, name))
+        if members is None:
+            members = self._members[(user_id, name)] = {track.get('id') for track in playlist['tracks']}
+        return members
+    
+    def _entry(self, track: Dict) -> Dict:
+        """What a playlist stores for a track: a reference for library tracks,
+        a full copy for URL-only tracks the library can't resolve"""
+        track_id = track.get('id')
+        if self.library is not None and self.library.get_track_by_id(track_id) is not None:
+            return {'id': track_id}
+        # Plain dict copy so library Track records stay serializable
+        return dict(track)
+    
+    def resolve_tracks(self, user_id: str, name: str) -> List[Dict]:
+        """Playable tracks of a playlist, with references looked up in the library"""
+        playlist = self.get_playlist(user_id, name)
+        if playlist is None:
+            return []
+        get_track = self.library.get_track_by_id if self.library is not None else lambda track_id: None
+        tracks = []
+        for entry in playlist['tracks']:
+            track = get_track(entry.get('id'))
+            if track is not None:
+                tracks.append(track)
+            elif entry.get('url'):
+                tracks.append(entry)  # Snapshot of a URL-only track
+        return tracks
+    
+    def _commit(self, records: List[Record]):
+        """Apply mutation records and persist them as one transaction"""
+        with self.store.lock:
+            for record in records:
+                op, key = record[0], (record[1], record[2])
+                members = self._members.get(key)
+                apply_record(self.playlists, record, members)
+                if op == 'add' and members is not None:
+                    members.add(record[3].get('id'))
+                elif op == 'remove' and members is not None:
+                    members.difference_update(record[3:])
+                elif op in ('create', 'delete'):
+                    self._members.pop(key, None)
+            self.store.commit(records)
     
     def create_playlist(self, user_id: str, name: str) -> bool:
         """Create a new playlist for a user"""
-        if user_id not in self.playlists:
-            self.playlists[user_id] = {}
-        
-        if name in self.playlists[user_id]:
+        if name in self._user(user_id):
             return False  # Playlist already exists
         
-        self.playlists[user_id][name] = {
-            'name': name,
-            'tracks': [],
-            'created_at': self._get_timestamp()
-        }
-        
-        self.save_playlists()
+        self._commit([['create', user_id, name, self._get_timestamp()]])
         return True
     
     def add_track(self, user_id: str, playlist_name: str, track: Dict) -> bool:
         """Add a track to a playlist"""
-        if user_id not in self.playlists:
-            return False
-        
-        if playlist_name not in self.playlists[user_id]:
+        playlist = self._user(user_id).get(playlist_name)
+        if playlist is None:
             return False
         
         # Check if track already exists in playlist
-        for existing_track in self.playlists[user_id][playlist_name]['tracks']:
-            if existing_track.get('id') == track.get('id'):
-                return True  # Track already in playlist
+        if track.get('id') in self._membership(user_id, playlist_name, playlist):
+            return True  # Track already in playlist
         
-        self.playlists[user_id][playlist_name]['tracks'].append(track)
-        self.save_playlists()
+        self._commit([['add', user_id, playlist_name, self._entry(track)]])
         return True
     
-    def remove_track(self, user_id: str, playlist_name: str, track_id: str) -> bool:
-        """Remove a track from a playlist"""
-        if user_id not in self.playlists:
+    def add_tracks(self, user_id: str, playlist_name: str, tracks: List[Dict], create: bool = False) -> Optional[int]:
+        """Add several tracks in one transaction, skipping ones already present
+        
+        Returns how many were added, or None if the playlist doesn't exist
+        (with create=True it is created as part of the same transaction).
+        """
+        records = []
+        playlist = self._user(user_id).get(playlist_name)
+        if playlist is not None:
+            members = set(self._membership(user_id, playlist_name, playlist))
+        elif create:
+            records.append(['create', user_id, playlist_name, self._get_timestamp()])
+            members = set()
+        else:
+            return None
+        
+        for track in tracks:
+            track_id = track.get('id')
+            if track_id not in members:
+                members.add(track_id)
+                records.append(['add', user_id, playlist_name, self._entry(track)])
+        if records:
+            self._commit(records)
+        return len(records) - (playlist is None)
+    
+    def remove_tracks(self, user_id: str, playlist_name: str, track_ids: List[str]) -> Optional[int]:
+        """Remove several tracks in one transaction; returns how many were removed"""
+        playlist = self._user(user_id).get(playlist_name)
+        if playlist is None:
+            return None
+        
+        members = self._membership(user_id, playlist_name, playlist)
+        present = [track_id for track_id in dict.fromkeys(track_ids) if track_id in members]
+        if present:
+            self._commit([['remove', user_id, playlist_name, *present]])
+        return len(present)
+    
+    def reorder_playlist(self, user_id: str, playlist_name: str, track_ids: List[str]) -> bool:
+        """Put the listed tracks first, in the given order; unlisted tracks follow"""
+        if playlist_name not in self._user(user_id):
             return False
         
-        if playlist_name not in self.playlists[user_id]:
+        self._commit([['order', user_id, playlist_name, list(track_ids)]])
+        return True
+    
+    def move_track(self, user_id: str, playlist_name: str, from_index: int, to_index: int) -> bool:
+        """Move the track at one position to another (0-based)"""
+        playlist = self._user(user_id).get(playlist_name)
+        if playlist is None:
             return False
         
-        playlist = self.playlists[user_id][playlist_name]
-        playlist['tracks'] = [
-            track for track in playlist['tracks'] 
-            if track.get('id') != track_id
-        ]
+        track_ids = [track.get('id') for track in playlist['tracks']]
+        if not (0 <= from_index < len(track_ids) and 0 <= to_index < len(track_ids)):
+            return False
+        track_ids.insert(to_index, track_ids.pop(from_index))
+        return self.reorder_playlist(user_id, playlist_name, track_ids)
+    
+    def remove_track(self, user_id: str, playlist_name: str, track_id: str) -> bool:
+        """Remove a track from a playlist"""
+        playlist = self._user(user_id).get(playlist_name)
+        if playlist is None:
+            return False
         
-        self.save_playlists()
+        if track_id in self._membership(user_id, playlist_name, playlist):
+            self._commit([['remove', user_id, playlist_name, track_id]])
         return True
     
     def get_playlist(self, user_id: str, name: str) -> Optional[Dict]:
         """Get a specific playlist"""
-        if user_id in self.playlists and name in self.playlists[user_id]:
-            return self.playlists[user_id][name]
-        return None
+        return self._user(user_id).get(name)
     
     def get_user_playlists(self, user_id: str) -> Dict:
         """Get all playlists for a user"""
-        return self.playlists.get(user_id, {})
+        return self._user(user_id)
     
     def delete_playlist(self, user_id: str, name: str) -> bool:
         """Delete a playlist"""
-        if user_id in self.playlists and name in self.playlists[user_id]:
-            del self.playlists[user_id][name]
-            self.save_playlists()
+        if name in self._user(user_id):
+            self._commit([['delete', user_id, name]])
             return True
         return False
     
     def _get_timestamp(self) -> str:
         """Get current timestamp"""
         from datetime import datetime
-        return datetime.now().isoformat()
\ No newline at end of file
+        return datetime.now().isoformat()
@@ -0,0 +1,481 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# A mutation record is a JSON list: [op, user_id, playlist_name, *args]
+#   ["create", user_id, name, created_at]
+#   ["add", user_id, name, entry]      entry is {"id": ...} or a URL track copy
+#   ["remove", user_id, name, track_id, ...]
+#   ["order", user_id, name, [track_id, ...]]   listed tracks first, the rest after
+#   ["delete", user_id, name]
+Record = list
+
+SNAPSHOT_VERSION = 1
+
+
+def apply_record(playlists: Dict, record: Record, members: Optional[Set[str]] = None):
+    """Apply one mutation record to a user -> name -> playlist dict.
+
+    ``members`` is the set of track ids in the record's playlist, for
+    callers that keep one; without it adds scan the playlist.
+    """
+    op, user_id, name = record[0], record[1], record[2]
+    if op == 'create':
+        user_playlists = playlists.setdefault(user_id, {})
+        if name not in user_playlists:
+            user_playlists[name] = {'name': name, 'tracks': [], 'created_at': record[3]}
+        return
+
+    playlist = playlists.get(user_id, {}).get(name)
+    if playlist is None:
+        return
+    if op == 'add':
+        track_id = record[3].get('id')
+        if members is not None:
+            present = track_id in members
+        else:
+            present = any(track.get('id') == track_id for track in playlist['tracks'])
+        # Adds are idempotent, so replaying a journal over a newer snapshot is harmless
+        if not present:
+            playlist['tracks'].append(record[3])
+    elif op == 'remove':
+        removed = set(record[3:])
+        playlist['tracks'] = [track for track in playlist['tracks'] if track.get('id') not in removed]
+    elif op == 'order':
+        playlist['tracks'] = reorder_tracks(playlist['tracks'], record[3])
+    elif op == 'delete':
+        del playlists[user_id][name]
+
+
+def reorder_tracks(tracks: List[Dict], track_ids: List[str]) -> List[Dict]:
+    """Tracks in the order of ``track_ids``, followed by unlisted ones in their old order"""
+    position = {}
+    for track_id in track_ids:
+        position.setdefault(track_id, len(position))
+    unlisted = len(position)
+    # Stable sort, so unlisted tracks keep their relative order
+    return sorted(tracks, key=lambda track: position.get(track.get('id'), unlisted))
+
+
+def _write_atomic(path: str, data: str):
+    """Write a file via a temporary file and rename, so readers never see half of it"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonPlaylistStore:
+    """Whole-file store: every commit rewrites playlists.json atomically"""
+
+    # Lazy stores load users on demand and let idle ones be evicted
+    lazy = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()  # Guards ``playlists``
+        self._write_lock = threading.Lock()  # Guards the files
+        self._version = 0
+        self._written = 0
+        self.playlists: Dict = {}
+
+    def load(self) -> Dict:
+        """Load all playlists; the returned dict stays owned by the store"""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                self.playlists = data['playlists'] if data.get('version') == SNAPSHOT_VERSION else data
+            except Exception as e:
+                print(f"Error loading playlists: {e}")
+                self.playlists = {}
+        return self.playlists
+
+    def load_user(self, user_id: str) -> Dict:
+        """Playlists of one user (everything is in memory already)"""
+        return self.playlists.get(user_id, {})
+
+    def commit(self, records: List[Record]):
+        """Persist mutations that were already applied to ``playlists``"""
+        self.save()
+
+    def save(self):
+        """Rewrite the whole file"""
+        with self.lock:
+            data = json.dumps(self.playlists, separators=(',', ':'))
+            self._version += 1
+            version = self._version
+        # Written outside ``lock`` so readers and writers of playlists don't wait for the disk
+        with self._write_lock:
+            if version > self._written:  # A newer state may have been written already
+                _write_atomic(self.path, data)
+                self._written = version
+
+    def close(self):
+        pass
+
+
+class JournalPlaylistStore(JsonPlaylistStore):
+    """Snapshot plus append-only journal.
+
+    Each commit appends one compact JSON line holding a sequence number and
+    its records, so a write costs the size of the change, not of every
+    playlist. Once the journal grows past ``compact_bytes`` a background
+    thread writes a fresh snapshot (atomic rename) and drops the journal
+    segment it covers. Start-up replays the snapshot, then any journal
+    segments, skipping records the snapshot already contains.
+    """
+
+    def __init__(self, path: str, compact_bytes: int = 1024 * 1024, fsync: bool = True):
+        super().__init__(path)
+        self.journal_path = f"{path}.journal"
+        self.rotated_path = f"{path}.journal.old"
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self.seq = 0
+        self._journal = None
+        self._compactor: Optional[threading.Thread] = None
+        self._compact_lock = threading.Lock()  # One snapshot write at a time
+
+    def load(self) -> Dict:
+        snapshot_seq = 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == SNAPSHOT_VERSION:
+                    self.playlists, snapshot_seq = data['playlists'], data['seq']
+                else:
+                    self.playlists = data  # Legacy playlists.json
+            except Exception as e:
+                print(f"Error loading playlists snapshot: {e}")
+                self.playlists = {}
+        self.seq = snapshot_seq
+
+        for path in (self.rotated_path, self.journal_path):
+            self._replay(path, snapshot_seq)
+
+        self._journal = open(self.journal_path, 'a')
+        if os.path.exists(self.rotated_path) or self._journal.tell() >= self.compact_bytes:
+            self.compact()
+        return self.playlists
+
+    def _replay(self, path: str, snapshot_seq: int):
+        """Apply journal entries newer than the snapshot, dropping a torn tail"""
+        if not os.path.exists(path):
+            return
+        good_bytes = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("incomplete line")
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # Torn write at the tail from a crash
+                good_bytes += len(line)
+                if entry['seq'] <= snapshot_seq:
+                    continue
+                for record in entry['ops']:
+                    apply_record(self.playlists, record)
+                self.seq = max(self.seq, entry['seq'])
+        if good_bytes < os.path.getsize(path):
+            # Later appends must not be glued onto the torn line
+            with open(path, 'r+b') as f:
+                f.truncate(good_bytes)
+
+    def next_seq(self) -> int:
+        """Number a change; called under ``lock`` as the change is applied"""
+        with self.lock:
+            self.seq += 1
+            return self.seq
+
+    def commit(self, records: List[Record]):
+        if not records:
+            return
+        with self.lock:
+            self.write_entries([(self.next_seq(), records)])
+
+    def write_entries(self, entries: List[Tuple[int, List[Record]]]):
+        """Append numbered changes to the journal in one write.
+
+        An entry may only reach the journal after a compaction has already
+        put its change into the snapshot; its seq is then covered by the
+        snapshot's and replay skips it.
+        """
+        with self._write_lock:
+            self._journal.write(''.join(
+                json.dumps({'seq': seq, 'ops': records}, separators=(',', ':')) + '\n' for seq, records in entries))
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            if self._journal.tell() >= self.compact_bytes:
+                self.compact_in_background()
+
+    def compact_in_background(self):
+        """Start a compaction unless one is already running"""
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self.compact, daemon=True)
+            self._compactor.start()
+
+    def compact(self):
+        """Fold the journal into a new snapshot"""
+        with self._compact_lock:
+            with self.lock, self._write_lock:
+                # seq counts every change applied to playlists, journaled yet or not
+                snapshot = json.dumps({'version': SNAPSHOT_VERSION, 'seq': self.seq, 'playlists': self.playlists},
+                                      separators=(',', ':'))
+                if not os.path.exists(self.rotated_path):
+                    # New commits go to a fresh journal while the snapshot is written
+                    self._journal.close()
+                    os.replace(self.journal_path, self.rotated_path)
+                    self._journal = open(self.journal_path, 'a')
+            _write_atomic(self.path, snapshot)
+            # Everything in the rotated segment is covered by the snapshot now
+            os.remove(self.rotated_path)
+
+    def save(self):
+        self.compact()
+
+    def close(self):
+        with self._write_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class SqlitePlaylistStore:
+    """SQLite-backed store that loads each user's playlists on demand.
+
+    Playlists are keyed by (user_id, name) and tracks by (playlist,
+    position); the database runs in WAL mode so reads never wait for a
+    writer. Every commit is a single SQL transaction.
+    """
+
+    lazy = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS playlists (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            created_at TEXT,
+            UNIQUE (user_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS playlist_tracks (
+            playlist_id INTEGER NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            track_id TEXT,
+            track TEXT NOT NULL,
+            PRIMARY KEY (playlist_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS playlist_tracks_by_id ON playlist_tracks (playlist_id, track_id);
+    """
+
+    def __init__(self, path: str, import_from: Optional[str] = None):
+        self.path = path
+        self.import_from = import_from
+        self.lock = threading.RLock()  # Guards the manager's in-memory playlists
+        self._db_lock = threading.RLock()  # Guards the connection
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(self.SCHEMA)
+
+    def load(self) -> Dict:
+        """Start with an empty cache, importing JSON playlists into a new database"""
+        with self._db_lock:
+            empty = self.db.execute("SELECT 1 FROM playlists LIMIT 1").fetchone() is None
+        if empty and self.import_from and os.path.exists(self.import_from):
+            legacy = JournalPlaylistStore(self.import_from)
+            playlists = legacy.load()
+            legacy.close()
+            records = []
+            for user_id, user_playlists in playlists.items():
+                for name, playlist in user_playlists.items():
+                    records.append(['create', user_id, name, playlist.get('created_at')])
+                    records.extend(['add', user_id, name, track] for track in playlist['tracks'])
+            self.commit(records)
+        return {}
+
+    def load_user(self, user_id: str) -> Dict:
+        """Read all playlists of one user"""
+        with self._db_lock:
+            rows = self.db.execute(
+                "SELECT id, name, created_at FROM playlists WHERE user_id = ?", (user_id,)).fetchall()
+            playlists = {}
+            for playlist_id, name, created_at in rows:
+                tracks = [json.loads(track) for (track,) in self.db.execute(
+                    "SELECT track FROM playlist_tracks WHERE playlist_id = ? ORDER BY position", (playlist_id,))]
+                playlists[name] = {'name': name, 'tracks': tracks, 'created_at': created_at}
+        return playlists
+
+    def _playlist_id(self, user_id: str, name: str) -> Optional[int]:
+        row = self.db.execute(
+            "SELECT id FROM playlists WHERE user_id = ? AND name = ?", (user_id, name)).fetchone()
+        return row[0] if row else None
+
+    def commit(self, records: List[Record]):
+        """Apply mutation records in one transaction"""
+        if not records:
+            return
+        with self._db_lock, self.db:
+            for record in records:
+                op, user_id, name = record[0], record[1], record[2]
+                if op == 'create':
+                    self.db.execute("INSERT OR IGNORE INTO playlists (user_id, name, created_at) VALUES (?, ?, ?)",
+                                    (user_id, name, record[3]))
+                    continue
+                playlist_id = self._playlist_id(user_id, name)
+                if playlist_id is None:
+                    continue
+                if op == 'add':
+                    track = record[3]
+                    exists = self.db.execute(
+                        "SELECT 1 FROM playlist_tracks WHERE playlist_id = ? AND track_id = ?",
+                        (playlist_id, track.get('id'))).fetchone()
+                    if not exists:
+                        self.db.execute(
+                            "INSERT INTO playlist_tracks (playlist_id, position, track_id, track) "
+                            "SELECT ?, COALESCE(MAX(position) + 1, 0), ?, ? FROM playlist_tracks WHERE playlist_id = ?",
+                            (playlist_id, track.get('id'), json.dumps(track, separators=(',', ':')), playlist_id))
+                elif op == 'remove':
+                    self.db.executemany("DELETE FROM playlist_tracks WHERE playlist_id = ? AND track_id = ?",
+                                        [(playlist_id, track_id) for track_id in record[3:]])
+                elif op == 'order':
+                    rows = self.db.execute(
+                        "SELECT track_id, track FROM playlist_tracks WHERE playlist_id = ? ORDER BY position",
+                        (playlist_id,)).fetchall()
+                    tracks = reorder_tracks([{'id': track_id, 'row': track} for track_id, track in rows], record[3])
+                    self.db.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+                    self.db.executemany(
+                        "INSERT INTO playlist_tracks (playlist_id, position, track_id, track) VALUES (?, ?, ?, ?)",
+                        [(playlist_id, position, track['id'], track['row']) for position, track in enumerate(tracks)])
+                elif op == 'delete':
+                    self.db.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+
+    def save(self):
+        """Checkpoint the WAL into the main database file"""
+        with self._db_lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._db_lock:
+            self.db.close()
+
+
+class WriteBehindStore:
+    """Buffers the commits of another store and flushes them in the background.
+
+    Mutations only append to an in-memory batch; a flusher thread hands the
+    whole batch to the wrapped store once per ``flush_interval`` seconds (the
+    durability window), on ``save`` and on ``close``. A burst of changes
+    therefore costs one write instead of one per change. A journal is
+    given each change numbered as it is applied, so a compaction that runs
+    before the flush doesn't replay it twice.
+    """
+
+    def __init__(self, inner, flush_interval: float = 1.0):
+        self.inner = inner
+        self.lock = inner.lock
+        self.lazy = inner.lazy
+        self.flush_interval = flush_interval
+        self._numbered = hasattr(inner, 'write_entries')
+        self._pending: List[Tuple[Optional[int], List[Record]]] = []  # (seq, records) per commit
+        self._flush_lock = threading.Lock()  # Keeps batches in order
+        self._oldest_pending = 0.0
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        # Flush metrics, in seconds
+        self.flushes = 0
+        self.records_flushed = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+
+    def load(self) -> Dict:
+        playlists = self.inner.load()
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run, name="playlist-flusher", daemon=True)
+            self._flusher.start()
+        return playlists
+
+    def load_user(self, user_id: str) -> Dict:
+        # A lazy backend must see pending writes before it is read again.
+        # Call without holding ``lock``: the flush takes it after _flush_lock
+        self.flush()
+        return self.inner.load_user(user_id)
+
+    def commit(self, records: List[Record]):
+        if not records:
+            return
+        with self.lock:
+            if not self._pending:
+                self._oldest_pending = time.monotonic()
+            self._pending.append((self.inner.next_seq() if self._numbered else None, records))
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing playlists: {e}")
+
+    def flush(self):
+        """Write everything buffered so far as one commit of the wrapped store"""
+        with self._flush_lock:
+            with self.lock:
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                oldest_pending = self._oldest_pending
+            # The write happens outside ``lock``, so mutations don't wait for the disk
+            started = time.monotonic()
+            try:
+                if self._numbered:
+                    self.inner.write_entries(batch)
+                else:
+                    self.inner.commit([record for _, records in batch for record in records])
+            except BaseException:
+                with self.lock:
+                    self._pending[:0] = batch  # Retry on the next flush
+                    self._oldest_pending = oldest_pending
+                raise
+            finished = time.monotonic()
+            self.flushes += 1
+            self.records_flushed += sum(len(records) for _, records in batch)
+            self.last_flush_duration = finished - started
+            self.max_flush_duration = max(self.max_flush_duration, self.last_flush_duration)
+            self.last_flush_lag = finished - oldest_pending
+            self.max_flush_lag = max(self.max_flush_lag, self.last_flush_lag)
+
+    def stats(self) -> Dict[str, Any]:
+        """Flush counters and latencies (milliseconds)"""
+        return {
+            'pending': sum(len(records) for _, records in self._pending),
+            'flushes': self.flushes,
+            'records_flushed': self.records_flushed,
+            'flush_interval_ms': self.flush_interval * 1000,
+            'last_flush_ms': self.last_flush_duration * 1000,
+            'max_flush_ms': self.max_flush_duration * 1000,
+            'last_flush_lag_ms': self.last_flush_lag * 1000,
+            'max_flush_lag_ms': self.max_flush_lag * 1000,
+        }
+
+    def save(self):
+        self.flush()
+        self.inner.save()
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self.inner.close()
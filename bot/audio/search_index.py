@@ -0,0 +1,346 @@
+import re
+import heapq
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Searchable fields and their relevance weights
+FIELD_WEIGHTS = (('title', 10), ('artist', 8), ('album', 5))
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text) -> List[str]:
+    """Split text into lowercase word tokens"""
+    if not text:
+        return []
+    return _TOKEN_RE.findall(str(text).lower())
+
+
+def trigrams(text) -> set:
+    """Character trigrams of each word, padded so word edges count"""
+    grams = set()
+    for token in tokenize(text):
+        padded = f" {token} "
+        for start in range(len(padded) - 2):
+            grams.add(padded[start:start + 3])
+    return grams
+
+
+class SearchIndex:
+    """Inverted token index over title/artist/album with prefix lookup.
+
+    Tracks are addressed by document numbers (their position in ``docs``).
+    Each field keeps its own postings so field weights come straight from
+    the index, and the sorted vocabulary lets a query term match every
+    token it is a prefix of. A character-trigram index over the same
+    documents backs typo-tolerant lookups.
+    """
+
+    # Fuzzy search bounds: postings scanned per query and candidates reranked
+    FUZZY_POSTING_BUDGET = 100_000
+    FUZZY_CANDIDATES = 200
+    FUZZY_MIN_COVERAGE = 0.4
+
+    def __init__(self):
+        self.docs: List[Optional[Dict]] = []
+        self.docno_by_id: Dict[str, int] = {}
+        self.removed = 0
+        self.postings: Dict[str, Dict[str, set]] = {field: {} for field, _ in FIELD_WEIGHTS}
+        self._vocabulary: List[str] = []
+        self._vocabulary_dirty = False
+        self.trigrams: Dict[str, array] = {}
+
+    @classmethod
+    def build(cls, tracks: Iterable[Dict]) -> 'SearchIndex':
+        """Build an index for the given tracks, preserving their order"""
+        index = cls()
+        for track in tracks:
+            index.add(track)
+        return index
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, track: Dict) -> int:
+        """Index a track and return its document number"""
+        docno = len(self.docs)
+        self.docs.append(track)
+        self.docno_by_id.setdefault(track.get('id'), docno)
+        for field, _ in FIELD_WEIGHTS:
+            postings = self.postings[field]
+            for token in set(tokenize(track.get(field))):
+                posting = postings.get(token)
+                if posting is None:
+                    postings[token] = {docno}
+                    self._vocabulary_dirty = True
+                else:
+                    posting.add(docno)
+        for gram in self._document_trigrams(track):
+            posting = self.trigrams.get(gram)
+            if posting is None:
+                self.trigrams[gram] = array('I', (docno,))
+            else:
+                posting.append(docno)
+        return docno
+
+    def remove(self, docno: int):
+        """Drop a document from the index.
+
+        Token postings are cleaned up eagerly; trigram postings keep the dead
+        document number and skip it at query time, since changed tracks are
+        re-added under a new number.
+        """
+        track = self.docs[docno]
+        if track is None:
+            return
+        self.docs[docno] = None
+        self.removed += 1
+        if self.docno_by_id.get(track.get('id')) == docno:
+            del self.docno_by_id[track.get('id')]
+        for field, _ in FIELD_WEIGHTS:
+            postings = self.postings[field]
+            for token in set(tokenize(track.get(field))):
+                posting = postings.get(token)
+                if posting is None:
+                    continue
+                posting.discard(docno)
+                if not posting:
+                    del postings[token]
+                    self._vocabulary_dirty = True
+
+    def to_state(self, docs: Optional[List[Dict]] = None) -> Dict:
+        """Postings as plain, marshal-friendly data (documents not included).
+
+        With ``docs`` (every live document, in any order) document numbers
+        are renumbered to positions in that list and removed documents are
+        dropped, so the state matches ``build(docs)``. Raises ValueError if
+        ``docs`` holds other documents than the index.
+        """
+        if docs is None:
+            return {
+                'postings': {
+                    field: {token: array('I', sorted(posting)).tobytes() for token, posting in postings.items()}
+                    for field, postings in self.postings.items()
+                },
+                'vocabulary': self._vocabulary_view(),
+                'trigrams': {gram: posting.tobytes() for gram, posting in self.trigrams.items()},
+            }
+
+        if len(docs) != len(self.docs) - self.removed:
+            raise ValueError("documents do not match the index")
+        position = {id(doc): docno for docno, doc in enumerate(docs)}
+        renumber = [None] * len(self.docs)
+        for docno, doc in enumerate(self.docs):
+            if doc is not None:
+                new_docno = position.get(id(doc))
+                if new_docno is None:
+                    raise ValueError("documents do not match the index")
+                renumber[docno] = new_docno
+
+        trigram_state = {}
+        for gram, posting in self.trigrams.items():
+            live = sorted(renumber[docno] for docno in posting if renumber[docno] is not None)
+            if live:
+                trigram_state[gram] = array('I', live).tobytes()
+        return {
+            'postings': {
+                field: {token: array('I', sorted(renumber[docno] for docno in posting)).tobytes()
+                        for token, posting in postings.items()}
+                for field, postings in self.postings.items()
+            },
+            'vocabulary': self._vocabulary_view(),
+            'trigrams': trigram_state,
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict, docs: List[Dict]) -> 'SearchIndex':
+        """Rebuild an index from ``to_state`` output and its documents"""
+        index = cls()
+        index.docs = docs
+        for docno in range(len(docs) - 1, -1, -1):
+            index.docno_by_id[docs[docno].get('id')] = docno
+        for field, postings in state['postings'].items():
+            field_postings = index.postings[field]
+            for token, data in postings.items():
+                posting = array('I')
+                posting.frombytes(data)
+                field_postings[token] = set(posting)
+        index._vocabulary = state['vocabulary']
+        for gram, data in state['trigrams'].items():
+            posting = array('I')
+            posting.frombytes(data)
+            index.trigrams[gram] = posting
+        return index
+
+    @property
+    def fragmentation(self) -> float:
+        """Fraction of document numbers that belong to removed tracks"""
+        return self.removed / len(self.docs) if self.docs else 0.0
+
+    @staticmethod
+    def _document_trigrams(track: Dict) -> set:
+        """Trigrams of all searchable fields of a track"""
+        grams = set()
+        for field, _ in FIELD_WEIGHTS:
+            grams |= trigrams(track.get(field))
+        return grams
+
+    def _vocabulary_view(self) -> List[str]:
+        """Sorted list of every indexed token"""
+        if self._vocabulary_dirty:
+            tokens = set()
+            for postings in self.postings.values():
+                tokens.update(postings)
+            self._vocabulary = sorted(tokens)
+            self._vocabulary_dirty = False
+        return self._vocabulary
+
+    def _expand(self, term: str) -> List[str]:
+        """Return every indexed token that starts with ``term``"""
+        vocabulary = self._vocabulary_view()
+        start = bisect_left(vocabulary, term)
+        expansions = []
+        for position in range(start, len(vocabulary)):
+            token = vocabulary[position]
+            if not token.startswith(term):
+                break
+            expansions.append(token)
+        return expansions
+
+    def _term_postings(self, term: str) -> List[Tuple[set, int]]:
+        """Postings lists matching a term, paired with their field/exact flags"""
+        lists = []
+        for token in self._expand(term):
+            exact = token == term
+            for bit, (field, _) in enumerate(FIELD_WEIGHTS):
+                posting = self.postings[field].get(token)
+                if posting:
+                    flags = 1 << bit
+                    if exact:
+                        flags |= 1 << (bit + len(FIELD_WEIGHTS))
+                    lists.append((posting, flags))
+        return lists
+
+    def search(self, query: str, limit: int = 15) -> List[int]:
+        """Return document numbers of the best matches, most relevant first.
+
+        Every query term must match (as a prefix) a token in one of the
+        searchable fields. Work is proportional to the postings touched.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        term_lists = [self._term_postings(term) for term in terms]
+        # Most selective terms first so later terms only probe candidates
+        term_lists.sort(key=lambda lists: sum(len(posting) for posting, _ in lists))
+
+        matches: Optional[Dict[int, List[int]]] = None
+        for lists in term_lists:
+            if not lists:
+                return []
+            if matches is None:
+                matches = {}
+                for posting, flags in lists:
+                    for docno in posting:
+                        masks = matches.get(docno)
+                        if masks is None:
+                            matches[docno] = [flags]
+                        else:
+                            masks[0] |= flags
+                continue
+
+            scan_cost = sum(len(posting) for posting, _ in lists)
+            probe_cost = len(matches) * len(lists)
+            hits: Dict[int, int] = {}
+            if probe_cost < scan_cost:
+                for docno in matches:
+                    mask = 0
+                    for posting, flags in lists:
+                        if docno in posting:
+                            mask |= flags
+                    if mask:
+                        hits[docno] = mask
+            else:
+                for posting, flags in lists:
+                    for docno in posting:
+                        if docno in matches:
+                            hits[docno] = hits.get(docno, 0) | flags
+            matches = {docno: matches[docno] + [mask] for docno, mask in hits.items()}
+            if not matches:
+                return []
+
+        scored = ((self._score(masks), docno) for docno, masks in matches.items()
+                  if self.docs[docno] is not None)
+        best = heapq.nsmallest(limit, scored, key=lambda item: (-item[0], item[1]))
+        return [docno for _, docno in best]
+
+    @staticmethod
+    def _score(masks: List[int]) -> int:
+        """Relevance of a document from its per-term match masks"""
+        field_count = len(FIELD_WEIGHTS)
+        all_terms = ~0
+        score = 0
+        for mask in masks:
+            all_terms &= mask
+            # Best field this term matched in, plus a bonus for whole-word hits
+            for bit, (_, weight) in enumerate(FIELD_WEIGHTS):
+                if mask & (1 << bit):
+                    score += weight
+                    break
+            if mask >> field_count:
+                score += 1
+        # Fields that contain the whole query weigh the most
+        for bit, (_, weight) in enumerate(FIELD_WEIGHTS):
+            if all_terms & (1 << bit):
+                score += 2 * weight
+        return score
+
+    def fuzzy_search(self, query: str, limit: int = 15) -> List[int]:
+        """Return document numbers of tracks similar to a possibly misspelled query.
+
+        Candidates are counted from the rarest query trigrams first, within a
+        fixed postings budget, and only the best of them are reranked by how
+        much of the query each field covers.
+        """
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        lists = sorted((self.trigrams[gram] for gram in query_grams if gram in self.trigrams), key=len)
+        counts: Counter = Counter()
+        scanned = 0
+        for posting in lists:
+            if scanned and scanned + len(posting) > self.FUZZY_POSTING_BUDGET:
+                break
+            counts.update(posting)
+            scanned += len(posting)
+
+        scored = []
+        for docno, _ in counts.most_common(self.FUZZY_CANDIDATES):
+            track = self.docs[docno]
+            if track is None:
+                continue
+            score, coverage = self._similarity(query_grams, track)
+            if coverage >= self.FUZZY_MIN_COVERAGE:
+                scored.append((score, docno))
+        best = heapq.nsmallest(limit, scored, key=lambda item: (-item[0], item[1]))
+        return [docno for _, docno in best]
+
+    @staticmethod
+    def _similarity(query_grams: set, track: Dict) -> Tuple[float, float]:
+        """Weighted field similarity and overall query coverage of a track"""
+        score = 0.0
+        covered = set()
+        for field, weight in FIELD_WEIGHTS:
+            field_grams = trigrams(track.get(field))
+            if not field_grams:
+                continue
+            shared = query_grams & field_grams
+            if shared:
+                covered |= shared
+                # Dice coefficient keeps long fields from winning on size alone
+                score += weight * 2 * len(shared) / (len(query_grams) + len(field_grams))
+        return score, len(covered) / len(query_grams)
@@ -0,0 +1,176 @@
+import json
+import marshal
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from bot.audio.search_index import SearchIndex
+from bot.audio.track import TRACK_FIELDS, Track
+
+# File layout (little endian):
+#   header   MAGIC, u16 version, u16 section count
+#   table    per section: 4-byte name, u64 offset, u64 length
+#   STRS     UTF-8 bytes of every distinct string, back to back
+#   SOFF     u32 offsets into STRS, one per string plus an end offset
+#   TRKS     u32 string ids, one column per TRACK_FIELDS entry plus one
+#            for extra fields as JSON; NO_STRING marks a missing value and
+#            JSON_VALUE flags a non-string value stored as its JSON text
+#   INDX     marshal dump of SearchIndex.to_state(), numbered by TRKS row
+#   META     JSON: validators, track count, Python version of INDX
+MAGIC = b'ASLIBSNP'
+VERSION = 2
+NO_STRING = 0xFFFFFFFF
+JSON_VALUE = 0x80000000
+
+_HEADER = struct.Struct('<8sHH')
+_SECTION = struct.Struct('<4sQQ')
+
+
+class SnapshotError(Exception):
+    """The snapshot file is missing, corrupt or from another format version"""
+
+
+def write_snapshot(path: str, tracks: List[Track], index: Optional[SearchIndex] = None,
+                   meta: Optional[Dict] = None):
+    """Write tracks and their prebuilt indexes to ``path`` atomically.
+
+    The index is stored renumbered to the track positions, so one that has
+    been updated in place (removed tracks, changed ones re-added at the
+    end) is kept as well.
+    """
+    strings: Dict[str, int] = {}
+    string_bytes = bytearray()
+    offsets = array('I', [0])
+
+    def string_id(value) -> int:
+        if value is None:
+            return NO_STRING
+        if type(value) is not str:
+            # Numbers (ids, durations, years) must come back as numbers
+            return string_id(json.dumps(value, separators=(',', ':'))) | JSON_VALUE
+        sid = strings.get(value)
+        if sid is None:
+            sid = strings[value] = len(offsets) - 1
+            if sid >= JSON_VALUE:
+                raise ValueError("too many distinct strings for a snapshot")
+            string_bytes.extend(value.encode('utf-8'))
+            offsets.append(len(string_bytes))
+        return sid
+
+    columns = len(TRACK_FIELDS) + 1
+    rows = array('I')
+    for track in tracks:
+        for field in TRACK_FIELDS:
+            rows.append(string_id(track.get(field)))
+        extra = track.extra if isinstance(track, Track) else {
+            key: value for key, value in track.items() if key not in TRACK_FIELDS}
+        rows.append(string_id(json.dumps(extra, separators=(',', ':'))) if extra else NO_STRING)
+
+    sections = [
+        (b'STRS', bytes(string_bytes)),
+        (b'SOFF', offsets.tobytes()),
+        (b'TRKS', rows.tobytes()),
+    ]
+    if index is not None:
+        try:
+            state = index.to_state(tracks)
+        except ValueError:
+            state = None  # Not the index of these tracks; it is rebuilt on load
+        if state is not None:
+            sections.append((b'INDX', marshal.dumps(state)))
+    meta = dict(meta or {})
+    meta.update({
+        'tracks': len(tracks),
+        'columns': columns,
+        'python': list(sys.version_info[:2]),
+    })
+    sections.append((b'META', json.dumps(meta).encode('utf-8')))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(sections)))
+        offset = _HEADER.size + _SECTION.size * len(sections)
+        for name, data in sections:
+            f.write(_SECTION.pack(name, offset, len(data)))
+            offset += len(data)
+        for _, data in sections:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Tuple[List[Track], Optional[SearchIndex], Dict]:
+    """Load tracks, their index (if stored and compatible) and metadata.
+
+    The file is memory-mapped and every distinct string is decoded once, so
+    repeated artist/album values share a single object.
+    """
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            return _parse(view)
+    except (OSError, ValueError, EOFError, TypeError, KeyError, IndexError, struct.error) as e:
+        raise SnapshotError(f"Cannot read snapshot {path}: {e}") from e
+
+
+def _parse(view: mmap.mmap) -> Tuple[List[Track], Optional[SearchIndex], Dict]:
+    magic, version, count = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"not a version {VERSION} library snapshot")
+    sections = {}
+    for position in range(count):
+        name, offset, length = _SECTION.unpack_from(view, _HEADER.size + position * _SECTION.size)
+        if offset + length > len(view):
+            raise ValueError(f"section {name!r} is truncated")
+        sections[name] = (offset, length)
+
+    buffer = memoryview(view)
+    try:
+        def section(name: bytes) -> memoryview:
+            offset, length = sections[name]
+            return buffer[offset:offset + length]
+
+        with section(b'META') as raw_meta:
+            meta = json.loads(bytes(raw_meta))
+        with section(b'STRS') as data, section(b'SOFF') as raw_offsets:
+            offsets = array('I')
+            offsets.frombytes(raw_offsets)
+            strings = [str(data[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(len(offsets) - 1)]
+        rows = array('I')
+        with section(b'TRKS') as raw_rows:
+            rows.frombytes(raw_rows)
+        state = None
+        if b'INDX' in sections and meta.get('python') == list(sys.version_info[:2]):
+            with section(b'INDX') as raw_index:
+                state = marshal.loads(raw_index)
+    finally:
+        buffer.release()
+
+    columns = meta['columns']
+    if columns != len(TRACK_FIELDS) + 1 or len(rows) != meta['tracks'] * columns:
+        raise ValueError("track table does not match its metadata")
+
+    json_values = {}
+
+    def value(sid: int):
+        if sid == NO_STRING:
+            return None
+        if sid & JSON_VALUE:
+            decoded = json_values.get(sid)
+            if decoded is None:
+                decoded = json_values[sid] = json.loads(strings[sid & ~JSON_VALUE])
+            return decoded
+        return strings[sid]
+
+    tracks = []
+    for start in range(0, len(rows), columns):
+        values = [value(sid) for sid in rows[start:start + columns - 1]]
+        extra_id = rows[start + columns - 1]
+        extra = None if extra_id == NO_STRING else json.loads(strings[extra_id])
+        tracks.append(Track.from_fields(values, extra))
+
+    index = SearchIndex.from_state(state, tracks) if state is not None else None
+    return tracks, index, meta
@@ -0,0 +1,79 @@
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+# Fields every library track carries, stored in slots
+TRACK_FIELDS = ('id', 'title', 'artist', 'album', 'duration', 'url', 'file_path', 'genre', 'year')
+_FIELD_SET = frozenset(TRACK_FIELDS)
+# Fields whose values repeat across many tracks and are worth interning
+_INTERNED_FIELDS = frozenset(('artist', 'album', 'genre', 'year', 'duration'))
+
+
+class Track(Mapping):
+    """Compact, read-only library track.
+
+    Known fields live in ``__slots__`` and repeated strings are interned, so
+    a track costs a fraction of the dict it was parsed from. It is still a
+    mapping: ``track.get('title')``, ``track['url']`` and ``dict(track)``
+    all behave like they did on the plain dict.
+    """
+
+    __slots__ = TRACK_FIELDS + ('extra',)
+
+    def __init__(self, data: Mapping):
+        get = data.get
+        for field in TRACK_FIELDS:
+            value = get(field)
+            if field in _INTERNED_FIELDS and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, field, value)
+        extra = {key: value for key, value in data.items() if key not in _FIELD_SET}
+        self.extra = extra or None
+
+    @classmethod
+    def from_fields(cls, values: Sequence, extra: Optional[Dict] = None) -> 'Track':
+        """Build a track from values in TRACK_FIELDS order, as stored in snapshots"""
+        track = cls.__new__(cls)
+        for field, value in zip(TRACK_FIELDS, values):
+            setattr(track, field, value)
+        track.extra = extra or None
+        return track
+
+    @classmethod
+    def from_data(cls, data: Mapping) -> 'Track':
+        """Return ``data`` as a Track, reusing it if it already is one"""
+        return data if isinstance(data, cls) else cls(data)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            return default if value is None else value
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __iter__(self) -> Iterator[str]:
+        for field in TRACK_FIELDS:
+            if getattr(self, field) is not None:
+                yield field
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain dict copy, e.g. for JSON serialization"""
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"Track({self.to_dict()!r})"
@@ -0,0 +1,208 @@
+import random
+from typing import Any, Iterable, Iterator, List, Optional
+
+
+class _Node:
+    __slots__ = ('value', 'priority', 'size', 'left', 'right')
+
+    def __init__(self, value, priority: float):
+        self.value = value
+        self.priority = priority
+        self.size = 1
+        self.left: Optional['_Node'] = None
+        self.right: Optional['_Node'] = None
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node is not None else 0
+
+
+def _update(node: _Node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+
+def _split(node: Optional[_Node], count: int):
+    """Split into the first ``count`` items and the rest"""
+    if node is None:
+        return None, None
+    if _size(node.left) >= count:
+        left, node.left = _split(node.left, count)
+        _update(node)
+        return left, node
+    node.right, right = _split(node.right, count - _size(node.left) - 1)
+    _update(node)
+    return node, right
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+class TrackQueue:
+    """Play queue with O(log n) positional insert, remove and move.
+
+    An implicit treap: tracks are ordered by position and every node
+    knows its subtree size, so any index is reached in logarithmic
+    expected time. It keeps the parts of the deque interface the player
+    uses (append, appendleft, popleft, clear, iteration, len).
+    """
+
+    def __init__(self, tracks: Iterable = ()):
+        self._root: Optional[_Node] = None
+        self.extend(tracks)
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __bool__(self) -> bool:
+        return self._root is not None
+
+    def __iter__(self) -> Iterator:
+        return self.iter_from(0)
+
+    def __getitem__(self, index: int):
+        node = self._root
+        index = self._check_index(index)
+        while True:
+            left_size = _size(node.left)
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node.value
+            else:
+                index -= left_size + 1
+                node = node.right
+
+    def _check_index(self, index: int) -> int:
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("queue index out of range")
+        return index
+
+    @staticmethod
+    def _build(values: List) -> Optional[_Node]:
+        """Balanced treap over values in O(n)"""
+        if not values:
+            return None
+        # Build a balanced tree, then hand out priorities in level order so
+        # every parent outranks its children
+        nodes = [_Node(value, 0.0) for value in values]
+
+        def link(start: int, stop: int) -> Optional[_Node]:
+            if start >= stop:
+                return None
+            middle = (start + stop) // 2
+            node = nodes[middle]
+            node.left = link(start, middle)
+            node.right = link(middle + 1, stop)
+            _update(node)
+            return node
+
+        root = link(0, len(nodes))
+        priorities = sorted((random.random() for _ in nodes), reverse=True)
+        level = [root]
+        position = 0
+        while level:
+            next_level = []
+            for node in level:
+                node.priority = priorities[position]
+                position += 1
+                if node.left is not None:
+                    next_level.append(node.left)
+                if node.right is not None:
+                    next_level.append(node.right)
+            level = next_level
+        return root
+
+    def insert(self, index: int, track):
+        """Insert a track before ``index`` (clamped like list.insert)"""
+        index = max(0, min(index if index >= 0 else len(self) + index, len(self)))
+        left, right = _split(self._root, index)
+        self._root = _merge(_merge(left, _Node(track, random.random())), right)
+
+    def append(self, track):
+        self._root = _merge(self._root, _Node(track, random.random()))
+
+    def appendleft(self, track):
+        self._root = _merge(_Node(track, random.random()), self._root)
+
+    def extend(self, tracks: Iterable):
+        """Append many tracks, building them into a balanced subtree first"""
+        self._root = _merge(self._root, self._build(list(tracks)))
+
+    def insert_many(self, index: int, tracks: Iterable):
+        """Insert a batch of tracks before ``index``, keeping their order"""
+        index = max(0, min(index if index >= 0 else len(self) + index, len(self)))
+        left, right = _split(self._root, index)
+        self._root = _merge(_merge(left, self._build(list(tracks))), right)
+
+    def pop(self, index: int = -1):
+        """Remove and return the track at ``index``"""
+        index = self._check_index(index)
+        left, rest = _split(self._root, index)
+        node, right = _split(rest, 1)
+        self._root = _merge(left, right)
+        return node.value
+
+    def popleft(self):
+        return self.pop(0)
+
+    def move(self, from_index: int, to_index: int):
+        """Move a track so it ends up at ``to_index``"""
+        track = self.pop(from_index)
+        self.insert(to_index, track)
+        return track
+
+    def clear(self):
+        self._root = None
+
+    def shuffle(self):
+        tracks = list(self)
+        random.shuffle(tracks)
+        self._root = self._build(tracks)
+
+    def iter_from(self, start: int) -> Iterator:
+        """Iterate from position ``start`` on, lazily"""
+        stack = []
+        node = self._root
+        while node is not None:
+            left_size = _size(node.left)
+            if start < left_size:
+                stack.append(node)
+                node = node.left
+            elif start == left_size:
+                stack.append(node)
+                break
+            else:
+                start -= left_size + 1
+                node = node.right
+        while stack:
+            node = stack.pop()
+            yield node.value
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def slice(self, start: int, stop: int) -> List[Any]:
+        """Tracks in positions [start, stop), in O(log n + k)"""
+        if start >= stop:
+            return []
+        items = []
+        for track in self.iter_from(max(start, 0)):
+            items.append(track)
+            if len(items) >= stop - max(start, 0):
+                break
+        return items
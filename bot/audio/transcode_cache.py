@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TranscodeCache:
+    """On-disk cache of library tracks pre-encoded to Opus.
+
+    Once a track has been played ``HOT_PLAYS`` times it is encoded in the
+    background, one file at a time, to an Ogg Opus file. Later plays
+    stream that file with ``codec='copy'``, so ffmpeg only remuxes it and
+    nothing is decoded or re-encoded. Files are evicted least recently
+    played first once the cache grows past ``max_bytes``; file modification
+    times record the LRU order, so it survives restarts.
+    """
+
+    HOT_PLAYS = 2
+    BITRATE = '128k'
+    SUFFIX = '.opus'
+
+    def __init__(self, directory: str, max_bytes: int, ffmpeg: str = 'ffmpeg'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ffmpeg = ffmpeg
+        os.makedirs(directory, exist_ok=True)
+        self._files: 'OrderedDict[str, int]' = OrderedDict()  # key -> size, least recently used first
+        self._plays: Counter = Counter()
+        self._encoding = set()
+        self._encoder_slot: Optional[asyncio.Semaphore] = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.encodes = 0
+        self.failed = 0
+        self.evictions = 0
+        self._scan()
+
+    def _scan(self):
+        """Index existing files by age, dropping leftovers of interrupted encodes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif name.endswith(self.SUFFIX):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name[:-len(self.SUFFIX)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._files[key] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def _key(track) -> str:
+        return hashlib.sha1(f"{track.get('id')}\0{track.get('url')}".encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def lookup(self, track) -> Optional[str]:
+        """Path of the track's cached Opus file, if it has one"""
+        key = self._key(track)
+        if key not in self._files:
+            self.misses += 1
+            return None
+        self._files.move_to_end(key)
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            # Deleted behind our back
+            self.total_bytes -= self._files.pop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def record_play(self, track):
+        """Count a play, starting a background encode once the track is hot"""
+        key = self._key(track)
+        self._plays[key] += 1
+        if self._plays[key] >= self.HOT_PLAYS and key not in self._files and key not in self._encoding:
+            self._encoding.add(key)
+            asyncio.ensure_future(self._encode(key, track.get('url')))
+
+    async def _encode(self, key: str, url: str):
+        if self._encoder_slot is None:
+            self._encoder_slot = asyncio.Semaphore(1)
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            async with self._encoder_slot:
+                process = await asyncio.create_subprocess_exec(
+                    self.ffmpeg, '-nostdin', '-loglevel', 'error', '-y', '-i', url,
+                    '-vn', '-c:a', 'libopus', '-b:a', self.BITRATE, '-ar', '48000', '-ac', '2',
+                    '-f', 'opus', tmp_path,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError(stderr.decode(errors='replace').strip() or f"ffmpeg exited with {process.returncode}")
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error transcoding {url}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        finally:
+            self._encoding.discard(key)
+
+        self._files[key] = size
+        self.total_bytes += size
+        self.encodes += 1
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'files': len(self._files),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'encoding': len(self._encoding),
+            'encodes': self.encodes,
+            'failed': self.failed,
+            'evictions': self.evictions,
+        }
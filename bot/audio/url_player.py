@@ -1,32 +1,78 @@
 import discord
 import asyncio
-from collections import deque
-import random
-import yt_dlp
+from itertools import islice
 import logging
+import time
+from typing import Dict, Optional, Tuple
+from bot.audio.broadcast import BroadcastHub
+from bot.audio.extractor import ExtractionPool
+from bot.audio.track import Track
+from bot.audio.track_queue import TrackQueue
+from bot.audio.transcode_cache import TranscodeCache
+from bot.audio.volume import RampingVolumeTransformer
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Used by players that aren't given a pool of their own
+_default_extractor = None
+
+def default_extractor() -> ExtractionPool:
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = ExtractionPool()
+    return _default_extractor
+
 class URLMusicPlayer:
-    def __init__(self, server_url):
+    # Queued tracks resolved ahead of time, so transitions don't wait on yt-dlp
+    PREFETCH_DEPTH = 2
+    # Tracks per page of /queue
+    QUEUE_PAGE_SIZE = 20
+    # Attempts per track, and the backoff (doubled each time) between
+    # attempts and between consecutive tracks that failed
+    MAX_ATTEMPTS = 3
+    RETRY_BACKOFF = 0.5
+    MAX_BACKOFF = 10.0
+    # A track that failed every attempt is skipped for this long
+    POISON_SECONDS = 600
+    POISON_LIMIT = 1000
+    
+    def __init__(self, server_url, guild_id=None, extractor: ExtractionPool = None,
+                 transcode_cache: TranscodeCache = None, broadcast_hub: BroadcastHub = None,
+                 opus_passthrough: bool = False):
         self.server_url = server_url.rstrip('/')
-        self.queue = deque()
+        self.guild_id = guild_id
+        self.extractor = extractor or default_extractor()  # Shared yt-dlp worker pool
+        self.transcode_cache = transcode_cache  # Pre-encoded Opus files of hot library tracks
+        self.broadcast_hub = broadcast_hub  # Shared pipelines for streams played by several guilds
+        # Send Opus straight to discord at 100% volume; volume changes then wait for the next track
+        self.opus_passthrough = opus_passthrough
+        self.queue = TrackQueue()
         self.current_track = None
         self.is_playing = False
+        self._source = None  # Volume transformer of the playing track (None on the Opus path)
         self.volume = 1.0  # 0.0 to 2.0
         self.loop_mode = 0  # 0=off, 1=track, 2=queue
         self.voice_client = None
+        # id(track) -> (track, extraction task) for the next queued YouTube tracks
+        self._lookahead: Dict[int, Tuple[Dict, asyncio.Future]] = {}
+        # Playback scheduler: one task per player working through events
+        self._events: asyncio.Queue = asyncio.Queue()
+        self._scheduler: Optional[asyncio.Task] = None
+        self._interaction = None  # Where follow-up messages go
+        self._current_entry = None  # Queue entry being played, before YouTube metadata is merged in
+        self._playback = 0  # Bumped per started source, so stale 'finished' events are ignored
+        self._failures = 0  # Tracks in a row that could not be played
+        self._poisoned: Dict[str, float] = {}  # url -> monotonic time until which it is skipped
         
     async def add_to_queue(self, interaction, track, play_next=False, silent=False):
-        if play_next and self.queue:
+        if play_next:
             # Insert after current track
-            temp_queue = list(self.queue)
-            temp_queue.insert(0, track)
-            self.queue = deque(temp_queue)
+            self.queue.appendleft(track)
         else:
             self.queue.append(track)
+        self._refresh_lookahead()
             
         if not silent:
             await interaction.response.send_message(f"Added to queue: {track.get('title', 'Unknown')}")
@@ -34,129 +80,292 @@ class URLMusicPlayer:
         if not self.is_playing:
             await self.play_next(interaction)
     
+    async def add_many(self, interaction, tracks, play_next=False) -> int:
+        """Queue a batch of tracks in one step
+        
+        The lookahead is refreshed once for the whole batch and playback is
+        started at most once, after everything is queued. Without an
+        interaction (e.g. from the web API) playback only starts if the
+        player has been started from discord before.
+        """
+        tracks = list(tracks)
+        if not tracks:
+            return 0
+        if play_next:
+            self.queue.insert_many(0, tracks)
+        else:
+            self.queue.extend(tracks)
+        self._refresh_lookahead()
+        
+        if not self.is_playing and (interaction is not None or self._interaction is not None):
+            await self.play_next(interaction)
+        return len(tracks)
+    
+    @property
+    def current_entry(self):
+        """The queue entry being played, as it was queued
+        
+        ``current_track`` has the resolved YouTube metadata (and its
+        expiring stream URL) merged in; this is what should be saved.
+        """
+        return self._current_entry
+    
+    @property
+    def volume(self) -> float:
+        return self._volume
+    
+    @volume.setter
+    def volume(self, value: float):
+        """Applies to the playing track right away, ramping to the new level"""
+        self._volume = max(0.0, min(float(value), 2.0))
+        if self._source is not None:
+            self._source.volume = self._volume
+    
+    async def _create_source(self, track, audio_url, youtube: bool):
+        """Audio source for a track
+        
+        By default tracks are decoded to PCM so the volume can change while
+        they play. With ``opus_passthrough`` a track started at 100% volume
+        goes straight through ffmpeg to discord instead: cached files and
+        Opus streams are only remuxed, anything else is encoded once by
+        ffmpeg. Shared tracks join one Opus pipeline per URL for all
+        guilds, so they always play at 100%.
+        """
+        if track.get('shared') and self.broadcast_hub is not None:
+            self._source = None
+            return self.broadcast_hub.listen(
+                audio_url, lambda: discord.FFmpegOpusAudio(audio_url, bitrate=192, options='-vn'))
+        
+        if not self.opus_passthrough or self.volume != 1.0:
+            # Better FFmpeg options for audio quality; volume is applied
+            # in-process so it can change while the track plays
+            ffmpeg_options = {
+                'options': '-vn -ar 48000 -ac 2 -b:a 192k'
+            }
+            self._source = RampingVolumeTransformer(discord.FFmpegPCMAudio(audio_url, **ffmpeg_options),
+                                                    self.volume)
+            return self._source
+        
+        self._source = None
+        # Pre-encoded files only pay off when their Opus is sent as is;
+        # decoding them to PCM would just add a lossy generation
+        if self.transcode_cache is not None and isinstance(track, Track):
+            cached = self.transcode_cache.lookup(track)
+            self.transcode_cache.record_play(track)
+            if cached:
+                return discord.FFmpegOpusAudio(cached, codec='copy')
+        if youtube:
+            # YouTube mostly serves Opus already; the probe lets ffmpeg copy it
+            return await discord.FFmpegOpusAudio.from_probe(audio_url, options='-vn')
+        return discord.FFmpegOpusAudio(audio_url, bitrate=192, options='-vn')
+    
     def _is_youtube_url(self, url):
         """Check if the URL is a YouTube link"""
         return 'youtube.com' in url or 'youtu.be' in url
     
-    def _extract_youtube_info(self, url):
-        """Extract audio URL and metadata from YouTube link"""
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'restrictfilenames': True,
-            'noplaylist': True,
-            'nocheckcertificate': True,
-            'ignoreerrors': False,
-            'logtostderr': False,
-            'quiet': True,
-            'no_warnings': True,
-            'default_search': 'error',
-            'source_address': '0.0.0.0',
-            'prefer_ffmpeg': True,
-            'keepvideo': False,
-            'audioquality': '0',  # Best quality
-            'audioformat': 'mp3',
-        }
+    def _refresh_lookahead(self):
+        """Start resolving the next queued tracks and drop work for ones that left the window
         
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                # Get the best audio format URL
-                audio_url = None
-                if 'url' in info:
-                    audio_url = info['url']
-                elif 'entries' in info and info['entries']:
-                    audio_url = info['entries'][0]['url']
-                
-                return {
-                    'id': info.get('id', 'unknown'),
-                    'title': info.get('title', 'Unknown YouTube Track'),
-                    'artist': info.get('uploader', 'Unknown Uploader'),
-                    'album': 'YouTube',
-                    'url': audio_url,
-                    'duration': str(info.get('duration', 0)),
-                    'thumbnail': info.get('thumbnail', '')
-                }
-        except Exception as e:
-            logger.error(f"Error extracting YouTube info: {e}")
-            return None
+        Called after every queue change; results are keyed by track object,
+        so reordering keeps work that is still needed.
+        """
+        window = {}
+        for track in islice(self.queue, self.PREFETCH_DEPTH):
+            url = track.get('url')
+            if url and self._is_youtube_url(url):
+                window[id(track)] = track
+        for key in [key for key in self._lookahead if key not in window]:
+            _, task = self._lookahead.pop(key)
+            task.cancel()
+        for key, track in window.items():
+            if key not in self._lookahead:
+                task = asyncio.ensure_future(self.extractor.extract(track['url'], self.guild_id))
+                self._lookahead[key] = (track, task)
     
-    async def play_next(self, interaction):
-        # Handle loop modes
-        if self.loop_mode == 1 and self.current_track and not len(self.queue):
-            # Loop current track
-            self.queue.appendleft(self.current_track)
-        elif self.loop_mode == 2 and self.current_track:
-            # Loop entire queue
-            self.queue.append(self.current_track)
-            
-        if not self.queue:
-            self.is_playing = False
-            self.current_track = None
-            return
-            
-        self.current_track = self.queue.popleft()
-        self.is_playing = True
+    async def _resolve(self, track, prepared=None):
+        """YouTube metadata for a track, from its lookahead task if there is one"""
+        if prepared is not None:
+            try:
+                return await prepared
+            except asyncio.CancelledError:
+                pass
+        return await self.extractor.extract(track['url'], self.guild_id)
+    
+    async def play_next(self, interaction=None):
+        """Ask the scheduler to start playback if nothing is playing
         
-        # Get voice client
-        voice_client = interaction.guild.voice_client
-        if not voice_client:
-            return
+        Without an interaction the one from the last request is reused.
+        """
+        self._events.put_nowait(('start', interaction))
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.ensure_future(self._run_scheduler())
+    
+    async def _run_scheduler(self):
+        """Handle playback events one at a time, for as long as the player lives"""
+        while True:
+            kind, payload = await self._events.get()
+            try:
+                if kind == 'start':
+                    if payload is not None:
+                        self._interaction = payload
+                    if self.is_playing:
+                        continue
+                elif payload != self._playback:
+                    continue  # A source we already replaced or stopped
+                await self._advance()
+            except Exception as e:
+                logger.error(f"Error in playback scheduler: {e}")
+    
+    def _next_track(self):
+        """Pop the next playable track, applying loop modes and skipping poisoned ones"""
+        current = self._current_entry
+        if current is not None and not self._is_poisoned(current):
+            if self.loop_mode == 1 and not len(self.queue):
+                # Loop current track
+                self.queue.appendleft(current)
+            elif self.loop_mode == 2:
+                # Loop entire queue
+                self.queue.append(current)
         
+        while self.queue:
+            track = self.queue.popleft()
+            if not self._is_poisoned(track):
+                return track
+        return None
+    
+    def _is_poisoned(self, track) -> bool:
+        until = self._poisoned.get(track.get('url'))
+        return until is not None and until > time.monotonic()
+    
+    def _poison(self, track):
+        """Skip this track's URL for a while after it failed every attempt"""
+        now = time.monotonic()
+        if len(self._poisoned) >= self.POISON_LIMIT:
+            self._poisoned = {url: until for url, until in self._poisoned.items() if until > now}
+        self._poisoned[track.get('url')] = now + self.POISON_SECONDS
+    
+    async def _notify(self, message: str):
+        """Send a follow-up to the last interaction; playback must not fail on it"""
         try:
-            # Handle YouTube URLs
-            audio_url = self.current_track.get('url')
-            if not audio_url:
-                await interaction.followup.send("❌ Invalid audio URL")
+            await self._interaction.followup.send(message)
+        except Exception as e:
+            logger.error(f"Error sending message: {e}")
+    
+    async def _advance(self):
+        """Start the next track, moving past ones that keep failing"""
+        while True:
+            track = self._next_track()
+            self._current_entry = track
+            if track is None:
+                self.is_playing = False
+                self.current_track = None
+                self._source = None
                 return
             
-            # If it's a YouTube URL, extract the direct audio URL
-            if self._is_youtube_url(audio_url):
-                await interaction.followup.send(f"🔍 Processing YouTube link: {self.current_track.get('title', 'Unknown')}")
-                yt_info = self._extract_youtube_info(audio_url)
-                if yt_info and yt_info['url']:
-                    audio_url = yt_info['url']
-                    # Update current track with YouTube metadata
-                    self.current_track.update(yt_info)
-                else:
-                    await interaction.followup.send("❌ Failed to extract audio from YouTube link")
-                    # Continue to next track
-                    await self.play_next(interaction)
-                    return
+            self.current_track = track
+            self.is_playing = True
+            # Claim the prefetched result before the lookahead window moves on
+            entry = self._lookahead.pop(id(track), None)
+            prepared = entry[1] if entry is not None and entry[0] is track else None
+            self._refresh_lookahead()
             
-            # Play the audio with better quality settings
-            def after_playing(error):
-                if error:
-                    logger.error(f"Error playing track: {error}")
-                # Schedule next track
-                coro = self.play_next(interaction)
-                fut = asyncio.run_coroutine_threadsafe(coro, interaction.client.loop)
-                try:
-                    fut.result()
-                except Exception as e:
-                    logger.error(f"Error in after_playing: {e}")
-            
-            # Better FFmpeg options for audio quality
-            ffmpeg_options = {
-                'options': f'-vn -af "volume={self.volume}" -ar 48000 -ac 2 -b:a 192k'
-            }
-            
-            source = discord.FFmpegPCMAudio(audio_url, **ffmpeg_options)
+            voice_client = self._interaction.guild.voice_client if self._interaction else None
+            if not voice_client:
+                # Not connected: keep the track for when playback is started again
+                self.queue.appendleft(track)
+                self._current_entry = self.current_track = None
+                self.is_playing = False
+                return
             
-            # Stop any currently playing audio
-            if voice_client.is_playing():
-                voice_client.stop()
+            if await self._play_with_retry(track, voice_client, prepared):
+                self._failures = 0
+                return
             
+            self._poison(track)
+            self._failures += 1
+            # Back off before the next track, so a queue of dead links
+            # isn't hammered back to back
+            await asyncio.sleep(min(self.RETRY_BACKOFF * 2 ** (self._failures - 1), self.MAX_BACKOFF))
+            if not self.is_playing:
+                return  # Stopped while we waited
+    
+    async def _play_with_retry(self, track, voice_client, prepared=None) -> bool:
+        """Try to start a track a few times; False if it never played"""
+        if not track.get('url'):
+            await self._notify("❌ Invalid audio URL")
+            return False
+        
+        for attempt in range(self.MAX_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(min(self.RETRY_BACKOFF * 2 ** (attempt - 1), self.MAX_BACKOFF))
+                if self._current_entry is not track:
+                    return True  # Stopped or replaced while we waited
+            try:
+                await self._play(track, voice_client, prepared if not attempt else None, announce=not attempt)
+                return True
+            except Exception as e:
+                logger.error(f"Error playing track (attempt {attempt + 1}/{self.MAX_ATTEMPTS}): {e}")
+        
+        await self._notify(f"❌ Error playing track, skipping: {track.get('title', 'Unknown')}")
+        return False
+    
+    async def _play(self, track, voice_client, prepared=None, announce=True):
+        """Resolve and start one track; raises if it can't be played"""
+        audio_url = track.get('url')
+        
+        # If it's a YouTube URL, extract the direct audio URL
+        youtube = self._is_youtube_url(audio_url)
+        if youtube:
+            if announce and (prepared is None or not prepared.done()):
+                await self._notify(f"🔍 Processing YouTube link: {track.get('title', 'Unknown')}")
+            yt_info = await self._resolve(track, prepared)
+            if self._superseded(track):
+                return
+            if not yt_info or not yt_info['url']:
+                raise RuntimeError("Failed to extract audio from YouTube link")
+            audio_url = yt_info['url']
+            # Update current track with YouTube metadata (library
+            # tracks are read-only, so this works on a copy)
+            self.current_track = {**track, **yt_info}
+        
+        source = await self._create_source(track, audio_url, youtube)
+        if self._superseded(track):
+            # Stopped while the source was being set up: don't start it
+            if self._source is source:
+                self._source = None
+            source.cleanup()
+            return
+        
+        self._playback += 1
+        playback = self._playback
+        loop = asyncio.get_running_loop()
+        
+        def after_playing(error):
+            # Runs on the audio thread: hand the event over and return at once
+            if error:
+                logger.error(f"Error playing track: {error}")
+            loop.call_soon_threadsafe(self._events.put_nowait, ('finished', playback))
+        
+        # Stop any currently playing audio
+        if voice_client.is_playing():
+            voice_client.stop()
+        
+        try:
             voice_client.play(source, after=after_playing)
-            
-            # Send now playing message
-            await interaction.followup.send(f"🎵 Now playing: {self.current_track.get('title', 'Unknown')}")
-            
-        except Exception as e:
-            logger.error(f"Error playing track: {e}")
-            await interaction.followup.send(f"❌ Error playing track: {str(e)}")
-            # Continue to next track
-            await self.play_next(interaction)
+        except Exception:
+            # Never started, so discord won't clean it up: release the
+            # ffmpeg process (and a shared stream's listener reference)
+            if self._source is source:
+                self._source = None
+            source.cleanup()
+            raise
+        
+        # Send now playing message
+        await self._notify(f"🎵 Now playing: {self.current_track.get('title', 'Unknown')}")
+    
+    def _superseded(self, track) -> bool:
+        """Whether the player was stopped or moved on while ``track`` was being set up"""
+        return self._current_entry is not track or not self.is_playing
     
     async def skip(self, interaction):
         voice_client = interaction.guild.voice_client
@@ -170,15 +379,30 @@ class URLMusicPlayer:
     async def stop(self, interaction):
         voice_client = interaction.guild.voice_client
         if voice_client:
+            self._playback += 1  # The stopped source's 'finished' event is ignored
             voice_client.stop()
             self.queue.clear()
-            self.current_track = None
+            self._refresh_lookahead()
+            self._current_entry = self.current_track = None
+            self._source = None
             self.is_playing = False
             await interaction.response.send_message("⏹️ Stopped playback and cleared queue")
         else:
             await interaction.response.send_message("Not in a voice channel", ephemeral=True)
     
-    async def show_queue(self, interaction):
+    def close(self):
+        """Stop the scheduler and any prefetching, for a player that is being dropped"""
+        self._playback += 1
+        self.queue.clear()
+        self._refresh_lookahead()  # Cancels the prefetch tasks
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+            self._scheduler = None
+        self._current_entry = self.current_track = None
+        self._source = None
+        self.is_playing = False
+    
+    async def show_queue(self, interaction, page: int = 1):
         if not self.queue and not self.current_track:
             await interaction.response.send_message("Queue is empty")
             return
@@ -193,27 +417,32 @@ class URLMusicPlayer:
             description += f"**Now Playing:** {self.current_track.get('title', 'Unknown')} "
             description += f"[{self.current_track.get('artist', 'Unknown')}]\n\n"
         
-        for i, track in enumerate(self.queue, 1):
+        pages = max((len(self.queue) + self.QUEUE_PAGE_SIZE - 1) // self.QUEUE_PAGE_SIZE, 1)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * self.QUEUE_PAGE_SIZE
+        for i, track in enumerate(self.queue.slice(start, start + self.QUEUE_PAGE_SIZE), start + 1):
             description += f"{i}. {track.get('title', 'Unknown')} "
             description += f"[{track.get('artist', 'Unknown')}]\n"
             
             # Limit message length
-            if len(description) > 3500 and i < len(self.queue):
-                description += f"\n... and {len(self.queue) - i} more tracks"
+            if len(description) > 3500:
                 break
         
+        if pages > 1:
+            description += f"\nPage {page}/{pages} ({len(self.queue)} tracks)"
+        
         embed.description = description
         await interaction.response.send_message(embed=embed)
     
     async def clear_queue(self, interaction):
         self.queue.clear()
+        self._refresh_lookahead()
         await interaction.response.send_message("🗑️ Queue cleared")
     
     async def shuffle_queue(self, interaction):
         if self.queue:
-            queue_list = list(self.queue)
-            random.shuffle(queue_list)
-            self.queue = deque(queue_list)
+            self.queue.shuffle()
+            self._refresh_lookahead()
             await interaction.response.send_message("🔀 Queue shuffled")
         else:
             await interaction.response.send_message("Queue is empty", ephemeral=True)
@@ -223,17 +452,31 @@ class URLMusicPlayer:
             await interaction.response.send_message(f"Invalid position. Queue has {len(self.queue)} items", ephemeral=True)
             return
             
-        queue_list = list(self.queue)
-        removed_track = queue_list.pop(position - 1)
-        self.queue = deque(queue_list)
+        removed_track = self.queue.pop(position - 1)
+        self._refresh_lookahead()
         
         await interaction.response.send_message(f"Removed from queue: {removed_track.get('title', 'Unknown')}")
     
+    async def move_in_queue(self, interaction, from_position: int, to_position: int):
+        """Move a queued track to another position (1-based)"""
+        length = len(self.queue)
+        if not (1 <= from_position <= length and 1 <= to_position <= length):
+            await interaction.response.send_message(f"Invalid position. Queue has {length} items", ephemeral=True)
+            return
+        
+        track = self.queue.move(from_position - 1, to_position - 1)
+        self._refresh_lookahead()
+        
+        await interaction.response.send_message(f"Moved {track.get('title', 'Unknown')} to position {to_position}")
+    
     async def set_volume(self, interaction, volume: float):
         """Set volume (0.0 to 2.0)"""
         if 0.0 <= volume <= 2.0:
             self.volume = volume
-            await interaction.response.send_message(f"🔊 Volume set to {volume*100:.0f}%")
+            message = f"🔊 Volume set to {volume*100:.0f}%"
+            if self.is_playing and self._source is None and volume != 1.0:
+                message += " (from the next track)"  # The Opus path has no volume stage
+            await interaction.response.send_message(message)
         else:
             await interaction.response.send_message("Volume must be between 0.0 and 2.0", ephemeral=True)
     
@@ -249,8 +492,8 @@ class URLMusicPlayer:
     def get_player_state(self):
         """Get current player state for web UI"""
         return {
-            'current_track': self.current_track,
-            'queue': list(self.queue),
+            'current_track': dict(self.current_track) if self.current_track else None,
+            'queue': [dict(track) for track in self.queue],
             'is_playing': self.is_playing,
             'volume': self.volume,
             'loop_mode': self.loop_mode
@@ -0,0 +1,43 @@
+import audioop
+
+import discord
+
+
+class RampingVolumeTransformer(discord.PCMVolumeTransformer):
+    """PCM volume control that can be changed while a track plays.
+
+    Setting ``volume`` takes effect on the next 20 ms frame: the applied
+    gain moves towards it by at most ``GAIN_STEP`` per frame, so changes
+    fade in over a few frames instead of clicking. At exactly 100% the
+    frames are passed through untouched.
+    """
+
+    # Largest gain change per frame: 0% -> 100% takes 10 frames (200 ms)
+    GAIN_STEP = 0.1
+    MAX_GAIN = 2.0
+
+    def __init__(self, original, volume: float = 1.0):
+        super().__init__(original, volume)
+        self._gain = min(self._volume, self.MAX_GAIN)
+
+    @property
+    def gain(self) -> float:
+        """Gain currently being applied, which trails ``volume`` while ramping"""
+        return self._gain
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if not data:
+            return data
+
+        target = min(self._volume, self.MAX_GAIN)
+        gain = self._gain
+        if gain != target:
+            if abs(target - gain) <= self.GAIN_STEP:
+                gain = target
+            else:
+                gain += self.GAIN_STEP if target > gain else -self.GAIN_STEP
+            self._gain = gain
+        if gain == 1.0:
+            return data
+        return audioop.mul(data, 2, gain)
@@ -1,6 +1,7 @@
 import sys
 import os
 import asyncio
+import concurrent.futures
 import logging
 
 # Set up logging
@@ -19,11 +20,16 @@ from discord.ext import commands
 from dotenv import load_dotenv
 import requests
 import json
+import base64
+from typing import Literal, Optional
 from flask import Flask, jsonify, request
 from threading import Thread
 
 # Import our modules
 from bot.audio.url_player import URLMusicPlayer
+from bot.audio.extractor import ExtractionPool, StreamCache
+from bot.audio.transcode_cache import TranscodeCache
+from bot.audio.broadcast import BroadcastHub
 from bot.audio.library import MusicLibrary
 from bot.audio.playlist_manager import PlaylistManager
 
@@ -36,17 +42,50 @@ intents.voice_states = True
 intents.messages = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+class MusicBot(commands.Bot):
+    async def close(self):
+        # The library's pooled HTTP session belongs to this loop, so it is
+        # closed here, before bot.run() tears the loop down
+        try:
+            await music_library.close()
+        except Exception as e:
+            logger.error(f"Error closing music library: {e}")
+        await super().close()
+
+bot = MusicBot(command_prefix='!', intents=intents)
 
 # Initialize components
 MUSIC_SERVER_URL = os.getenv('MUSIC_SERVER_URL', 'http://localhost:3000')
-music_library = MusicLibrary(MUSIC_SERVER_URL)
-playlist_manager = PlaylistManager()
+music_library = MusicLibrary(MUSIC_SERVER_URL, autoload=False)
+music_library.load_local_library()  # Served until the background refresh lands
+# Playlist changes are written behind, within PLAYLIST_FLUSH_INTERVAL seconds
+# (0 writes every change through immediately)
+playlist_flush_interval = float(os.getenv('PLAYLIST_FLUSH_INTERVAL', '1.0'))
+playlist_manager = PlaylistManager(backend=os.getenv('PLAYLIST_BACKEND', 'journal'),
+                                   flush_interval=playlist_flush_interval or None,
+                                   library=music_library)
+# yt-dlp extractions run on a worker pool shared by all guilds; resolved
+# stream URLs are cached by video id (and kept across restarts unless
+# STREAM_CACHE_FILE is set to an empty string)
+extraction_pool = ExtractionPool(max_workers=int(os.getenv('EXTRACTION_WORKERS', '4')),
+                                 timeout=float(os.getenv('EXTRACTION_TIMEOUT', '30')),
+                                 cache=StreamCache(os.getenv('STREAM_CACHE_FILE', 'stream_cache.json') or None))
+# OPUS_PASSTHROUGH=1 skips PCM decoding for tracks played at 100% volume,
+# at the cost of volume changes only applying from the next track
+opus_passthrough = os.getenv('OPUS_PASSTHROUGH', '0').lower() in ('1', 'true', 'yes')
+# With passthrough, hot library tracks are kept pre-encoded to Opus
+# (TRANSCODE_CACHE_DIR set to an empty string disables this)
+transcode_cache_dir = os.getenv('TRANSCODE_CACHE_DIR', 'transcode_cache')
+transcode_cache = TranscodeCache(transcode_cache_dir, int(os.getenv('TRANSCODE_CACHE_MB', '2048')) * 1024 * 1024) \
+    if transcode_cache_dir and opus_passthrough else None
+# Guilds playing the same URL with shared=True share one ffmpeg pipeline
+broadcast_hub = BroadcastHub()
 music_players = {}  # Guild-specific players
 
 def get_player(guild_id):
     if guild_id not in music_players:
-        music_players[guild_id] = URLMusicPlayer(MUSIC_SERVER_URL)
+        music_players[guild_id] = URLMusicPlayer(MUSIC_SERVER_URL, guild_id, extraction_pool,
+                                                  transcode_cache, broadcast_hub, opus_passthrough)
     return music_players[guild_id]
 
 @bot.event
@@ -54,6 +93,9 @@ async def on_ready():
     print(f'{bot.user} has connected to Discord!')
     print(f"Bot is in {len(bot.guilds)} guilds")
     
+    # Fetch the latest library without holding up the event loop
+    music_library.start_background_refresh()
+    
     # Force sync commands when bot starts
     try:
         synced = await bot.tree.sync()
@@ -87,8 +129,9 @@ async def join(interaction: discord.Interaction):
 async def leave(interaction: discord.Interaction):
     if interaction.guild.voice_client:
         await interaction.guild.voice_client.disconnect()
-        if interaction.guild.id in music_players:
-            del music_players[interaction.guild.id]
+        player = music_players.pop(interaction.guild.id, None)
+        if player is not None:
+            player.close()
         await interaction.response.send_message("Left voice channel")
     else:
         await interaction.response.send_message("Not in a voice channel", ephemeral=True)
@@ -133,8 +176,8 @@ async def playnext(interaction: discord.Interaction, query: str):
     await player.add_to_queue(interaction, track, play_next=True)
 
 @bot.tree.command(name="playurl", description="Play audio directly from a URL")
-async def playurl(interaction: discord.Interaction, url: str):
-    """Play audio directly from a URL"""
+async def playurl(interaction: discord.Interaction, url: str, shared: bool = False):
+    """Play audio directly from a URL (shared=True joins other guilds' stream of it)"""
     # Validate URL format (basic check)
     if not url.startswith(('http://', 'https://')):
         await interaction.response.send_message("Please provide a valid HTTP/HTTPS URL", ephemeral=True)
@@ -155,7 +198,8 @@ async def playurl(interaction: discord.Interaction, url: str):
         'artist': "URL Source",
         'album': "Direct URL",
         'url': url,
-        'duration': "Unknown"
+        'duration': "Unknown",
+        'shared': shared
     }
     
     player = get_player(interaction.guild.id)
@@ -173,9 +217,9 @@ async def stop(interaction: discord.Interaction):
 
 # Queue management
 @bot.tree.command(name="queue", description="Show current queue")
-async def queue(interaction: discord.Interaction):
+async def queue(interaction: discord.Interaction, page: int = 1):
     player = get_player(interaction.guild.id)
-    await player.show_queue(interaction)
+    await player.show_queue(interaction, page)
 
 @bot.tree.command(name="clear", description="Clear the queue")
 async def clear(interaction: discord.Interaction):
@@ -192,6 +236,11 @@ async def remove(interaction: discord.Interaction, position: int):
     player = get_player(interaction.guild.id)
     await player.remove_from_queue(interaction, position)
 
+@bot.tree.command(name="move", description="Move a track to another position in the queue")
+async def move(interaction: discord.Interaction, from_position: int, to_position: int):
+    player = get_player(interaction.guild.id)
+    await player.move_in_queue(interaction, from_position, to_position)
+
 # Playback controls
 @bot.tree.command(name="volume", description="Set playback volume (0-200)")
 async def volume(interaction: discord.Interaction, volume: int):
@@ -247,34 +296,44 @@ async def search(interaction: discord.Interaction, query: str):
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="list", description="List all available tracks")
-async def list_tracks(interaction: discord.Interaction):
-    tracks = music_library.get_all_tracks()
-    if not tracks:
+async def list_tracks(interaction: discord.Interaction, page: int = 1,
+                      sort: Optional[Literal['title', 'artist', 'album', 'year', 'duration']] = None):
+    page_size = 20
+    tracks, total = music_library.get_tracks_page(offset=(max(page, 1) - 1) * page_size,
+                                                   limit=page_size, sort_by=sort)
+    if not total:
         await interaction.response.send_message("No tracks available", ephemeral=True)
         return
+    if not tracks:
+        await interaction.response.send_message(f"Page {page} is empty, the library has {total} tracks", ephemeral=True)
+        return
     
+    loading = " (still loading...)" if music_library.loading else ""
     embed = discord.Embed(
-        title=f"Music Library ({len(tracks)} tracks)",
+        title=f"Music Library ({total} tracks){loading}",
         color=0x4ecdc4
     )
     
+    first = (max(page, 1) - 1) * page_size
     description = ""
-    for i, track in enumerate(tracks[:20], 1):
+    for i, track in enumerate(tracks, first + 1):
         description += f"{i}. **{track.get('title', 'Unknown')}** - {track.get('artist', 'Unknown')}\n"
     
-    if len(tracks) > 20:
-        description += f"\n... and {len(tracks) - 20} more tracks"
+    pages = (total + page_size - 1) // page_size
+    if pages > 1:
+        description += f"\nPage {max(page, 1)}/{pages}"
     
     embed.description = description
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="refresh", description="Refresh music library from server")
 async def refresh(interaction: discord.Interaction):
-    success = music_library.refresh_library()
+    await interaction.response.defer()
+    success = await asyncio.shield(music_library.start_background_refresh())
     if success:
-        await interaction.response.send_message(f"✅ Library refreshed! {len(music_library.get_all_tracks())} tracks available")
+        await interaction.followup.send(f"✅ Library refreshed! {len(music_library.get_all_tracks())} tracks available")
     else:
-        await interaction.response.send_message("❌ Failed to refresh library", ephemeral=True)
+        await interaction.followup.send("❌ Failed to refresh library", ephemeral=True)
 
 # Server configuration commands
 @bot.tree.command(name="setserver", description="Set the default music server URL")
@@ -323,6 +382,77 @@ async def playlist_add(interaction: discord.Interaction, playlist_name: str, que
     else:
         await interaction.response.send_message(f"Playlist {playlist_name} not found", ephemeral=True)
 
+def split_queries(text):
+    """Search queries from a newline (or ';') separated list"""
+    if isinstance(text, list):
+        lines = text
+    else:
+        lines = text.replace(';', '\n').splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+async def queued_tracks(player):
+    """The now-playing track followed by the queue; runs on the bot's loop, which owns the queue"""
+    tracks = [player.current_entry] if player.current_entry else []
+    tracks.extend(player.queue)
+    return tracks
+
+@bot.tree.command(name="playlist_import", description="Add the best match of each query (separate with ;) to a playlist")
+async def playlist_import(interaction: discord.Interaction, playlist_name: str, queries: str):
+    user_id = str(interaction.user.id)
+    queries = split_queries(queries)
+    if not queries:
+        await interaction.response.send_message("No queries given", ephemeral=True)
+        return
+    
+    await interaction.response.defer()
+    matches = await asyncio.to_thread(music_library.search_many, queries)
+    tracks = [track for track in matches if track is not None]
+    added = playlist_manager.add_tracks(user_id, playlist_name, tracks, create=True)
+    message = f"Added {added} tracks to {playlist_name}"
+    missing = [query for query, track in zip(queries, matches) if track is None]
+    if missing:
+        message += f"\nNo results for: {', '.join(missing[:10])}"
+        if len(missing) > 10:
+            message += f" and {len(missing) - 10} more"
+    await interaction.followup.send(message)
+
+@bot.tree.command(name="playlist_import_queue", description="Save the current queue into a playlist")
+async def playlist_import_queue(interaction: discord.Interaction, playlist_name: str):
+    user_id = str(interaction.user.id)
+    tracks = await queued_tracks(get_player(interaction.guild.id))
+    if not tracks:
+        await interaction.response.send_message("The queue is empty", ephemeral=True)
+        return
+    
+    added = playlist_manager.add_tracks(user_id, playlist_name, tracks, create=True)
+    await interaction.response.send_message(f"Added {added} tracks from the queue to {playlist_name}")
+
+@bot.tree.command(name="playlist_remove", description="Remove tracks by position (e.g. 1,4,7)")
+async def playlist_remove(interaction: discord.Interaction, playlist_name: str, positions: str):
+    user_id = str(interaction.user.id)
+    playlist = playlist_manager.get_playlist(user_id, playlist_name)
+    if not playlist:
+        await interaction.response.send_message(f"Playlist {playlist_name} not found", ephemeral=True)
+        return
+    
+    try:
+        indexes = [int(position) - 1 for position in positions.replace(' ', '').split(',') if position]
+    except ValueError:
+        await interaction.response.send_message("Positions must be numbers separated by commas", ephemeral=True)
+        return
+    tracks = playlist['tracks']
+    track_ids = [tracks[index].get('id') for index in indexes if 0 <= index < len(tracks)]
+    removed = playlist_manager.remove_tracks(user_id, playlist_name, track_ids)
+    await interaction.response.send_message(f"Removed {removed} tracks from {playlist_name}")
+
+@bot.tree.command(name="playlist_move", description="Move a track to another position in a playlist")
+async def playlist_move(interaction: discord.Interaction, playlist_name: str, from_position: int, to_position: int):
+    user_id = str(interaction.user.id)
+    if playlist_manager.move_track(user_id, playlist_name, from_position - 1, to_position - 1):
+        await interaction.response.send_message(f"Moved track {from_position} to position {to_position} in {playlist_name}")
+    else:
+        await interaction.response.send_message("Playlist or position not found", ephemeral=True)
+
 @bot.tree.command(name="playlist_play", description="Play a playlist")
 async def playlist_play(interaction: discord.Interaction, playlist_name: str):
     if not interaction.user.voice:
@@ -339,11 +469,10 @@ async def playlist_play(interaction: discord.Interaction, playlist_name: str):
         await interaction.response.send_message(f"Playlist {playlist_name} not found", ephemeral=True)
         return
     
-    player = get_player(interaction.guild.id)
-    for track in playlist['tracks']:
-        await player.add_to_queue(interaction, track, silent=True)
-    
+    # Respond first: starting playback sends follow-up messages
     await interaction.response.send_message(f"Playing playlist: {playlist_name}")
+    player = get_player(interaction.guild.id)
+    await player.add_many(interaction, playlist_manager.resolve_tracks(user_id, playlist_name))
 
 @bot.tree.command(name="playlist_list", description="List your playlists")
 async def playlist_list(interaction: discord.Interaction):
@@ -392,13 +521,151 @@ def run_web_api():
     
     @app.route('/api/library')
     def get_library():
-        return jsonify(music_library.get_all_tracks())
+        """One page of the library: ?limit=&offset=|cursor=&sort=&order=&fields="""
+        sort_by = request.args.get('sort') or None
+        if sort_by and sort_by not in music_library.SORT_FIELDS:
+            return jsonify({'error': f"sort must be one of {', '.join(music_library.SORT_FIELDS)}"}), 400
+        descending = request.args.get('order', 'asc').lower() == 'desc'
+        fields = [field for field in request.args.get('fields', '').split(',') if field]
+        
+        # Read first, so a refresh during this request makes the next cursor stale
+        generation = music_library.generation
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+            cursor = request.args.get('cursor')
+            cursor_generation = None
+            if cursor:
+                # Cursors are opaque to clients: base64 of "<generation>:<offset>"
+                cursor_generation, offset = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+                cursor_generation, offset = int(cursor_generation), int(offset)
+            else:
+                offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return jsonify({'error': 'Invalid limit, offset or cursor'}), 400
+        if cursor_generation is not None and cursor_generation != generation:
+            # The library changed since the first page, so the same offset
+            # would skip or repeat tracks: the client has to start over
+            return jsonify({'error': 'Cursor is from an older version of the library; start again',
+                            'generation': generation}), 400
+        
+        tracks, total = music_library.get_tracks_page(offset, limit, sort_by, descending)
+        if fields:
+            items = [{field: track.get(field) for field in fields} for track in tracks]
+        else:
+            items = [track.to_dict() for track in tracks]
+        
+        next_cursor = None
+        if offset + len(tracks) < total:
+            next_cursor = base64.urlsafe_b64encode(
+                f"{generation}:{offset + len(tracks)}".encode()).decode()
+        return jsonify({
+            'tracks': items,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'next_cursor': next_cursor,
+            'generation': generation,
+        })
+    
+    @app.route('/api/queue/<int:guild_id>', methods=['POST'])
+    def enqueue_tracks(guild_id):
+        """Queue library tracks in one batch: {"track_ids": [...], "play_next": false}"""
+        try:
+            data = request.json or {}
+            if guild_id not in music_players:
+                return jsonify({'error': 'Player not found'}), 404
+            player = music_players[guild_id]
+            tracks = music_library.get_tracks_by_ids(data.get('track_ids') or [])
+            # The queue belongs to the bot's event loop
+            queued = asyncio.run_coroutine_threadsafe(
+                player.add_many(None, tracks, play_next=bool(data.get('play_next'))), bot.loop).result(timeout=10)
+            return jsonify({'queued': queued, 'queue_length': len(player.queue), 'is_playing': player.is_playing})
+        except concurrent.futures.TimeoutError:
+            logger.error(f"Timed out queueing tracks for guild {guild_id}")
+            return jsonify({'error': 'Timed out waiting for the bot'}), 504
+        except Exception as e:
+            logger.error(f"Error in enqueue_tracks API: {e}")
+            return jsonify({'error': 'Internal server error'}), 500
     
     @app.route('/api/search')
     def search_library():
         query = request.args.get('q', '')
-        results = music_library.search(query)
-        return jsonify(results)
+        fuzzy = request.args.get('fuzzy')
+        if fuzzy is not None:
+            fuzzy = fuzzy.lower() in ('1', 'true', 'yes')
+        results = music_library.search(query, fuzzy=fuzzy)
+        return jsonify([track.to_dict() for track in results])
+    
+    @app.route('/api/search/stats')
+    def search_stats():
+        return jsonify(music_library.cache_stats())
+    
+    @app.route('/api/extractor/stats')
+    def extractor_stats():
+        return jsonify(extraction_pool.stats())
+    
+    @app.route('/api/transcode/stats')
+    def transcode_stats():
+        return jsonify(transcode_cache.stats() if transcode_cache else {})
+    
+    @app.route('/api/broadcast/stats')
+    def broadcast_stats():
+        return jsonify(broadcast_hub.stats())
+    
+    @app.route('/api/playlists/stats')
+    def playlist_stats():
+        return jsonify(playlist_manager.store_stats())
+    
+    @app.route('/api/playlists/<user_id>/<name>/tracks', methods=['POST', 'DELETE'])
+    def playlist_tracks(user_id, name):
+        """Add (POST) or remove (DELETE) {"track_ids": [...]} in one transaction"""
+        track_ids = (request.json or {}).get('track_ids') or []
+        if request.method == 'POST':
+            count = playlist_manager.add_tracks(user_id, name, music_library.get_tracks_by_ids(track_ids))
+        else:
+            count = playlist_manager.remove_tracks(user_id, name, track_ids)
+        if count is None:
+            return jsonify({'error': 'Playlist not found'}), 404
+        key = 'added' if request.method == 'POST' else 'removed'
+        return jsonify({key: count, 'total': len(playlist_manager.get_playlist(user_id, name)['tracks'])})
+    
+    @app.route('/api/playlists/<user_id>/<name>/order', methods=['PUT'])
+    def playlist_order(user_id, name):
+        """Reorder a playlist: {"track_ids": [...]} first, other tracks after"""
+        track_ids = (request.json or {}).get('track_ids') or []
+        if not playlist_manager.reorder_playlist(user_id, name, track_ids):
+            return jsonify({'error': 'Playlist not found'}), 404
+        return jsonify({'status': 'ok'})
+    
+    @app.route('/api/playlists/<user_id>/<name>/import', methods=['POST'])
+    def playlist_import_queries(user_id, name):
+        """Add the best match of each query: {"queries": [...] or "one per line"}"""
+        queries = split_queries((request.json or {}).get('queries') or [])
+        matches = music_library.search_many(queries)
+        added = playlist_manager.add_tracks(user_id, name, [track for track in matches if track is not None],
+                                            create=True)
+        return jsonify({
+            'added': added,
+            'not_found': [query for query, track in zip(queries, matches) if track is None],
+        })
+    
+    @app.route('/api/playlists/<user_id>/<name>/import_queue/<int:guild_id>', methods=['POST'])
+    def playlist_import_player_queue(user_id, name, guild_id):
+        """Save a guild's now-playing track and queue into a playlist"""
+        try:
+            if guild_id not in music_players:
+                return jsonify({'error': 'Player not found'}), 404
+            # The queue is changed on the bot's event loop, so it is read there
+            tracks = asyncio.run_coroutine_threadsafe(
+                queued_tracks(music_players[guild_id]), bot.loop).result(timeout=10)
+            added = playlist_manager.add_tracks(user_id, name, tracks, create=True)
+            return jsonify({'added': added})
+        except concurrent.futures.TimeoutError:
+            logger.error(f"Timed out reading the queue of guild {guild_id}")
+            return jsonify({'error': 'Timed out waiting for the bot'}), 504
+        except Exception as e:
+            logger.error(f"Error in playlist_import_player_queue API: {e}")
+            return jsonify({'error': 'Internal server error'}), 500
     
     @app.route('/api/playurl/<int:guild_id>', methods=['POST'])
     def play_url(guild_id):
@@ -488,7 +755,7 @@ def run_web_api():
                 pass
             elif action == 'volume':
                 volume = request.json.get('volume', 100)
-                player.volume = volume / 100.0
+                player.volume = volume / 100.0  # Clamped to 0-200%, applied live
             elif action == 'loop':
                 mode = request.json.get('mode', 0)
                 player.loop_mode = mode
@@ -505,4 +772,9 @@ web_api_thread = Thread(target=run_web_api)
 web_api_thread.start()
 
 # Run the bot
-bot.run(os.getenv('DISCORD_TOKEN'))
\ No newline at end of file
+try:
+    bot.run(os.getenv('DISCORD_TOKEN'))
+finally:
+    # Write out any buffered playlist changes
+    playlist_manager.close()
+    extraction_pool.shutdown()
\ No newline at end of file
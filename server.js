@@ -15,36 +15,117 @@ if (fs.existsSync(path.join(__dirname, 'music'))) {
     console.log('⚠️  Music directory not found. Create a "music" folder with your audio files.');
 }
 
-// API endpoint for music library
-app.get('/api/music', (req, res) => {
+// Default mock library if nothing else exists
+const mockLibrary = [
+    {
+        id: 'track_001',
+        title: 'Example Song',
+        artist: 'Example Artist',
+        album: 'Example Album',
+        duration: '180',
+        url: 'http://localhost:3000/music/example.mp3',
+        file_path: '/music/example.mp3',
+        genre: 'Example',
+        year: '2023'
+    }
+];
+
+// Recent library versions by ETag, so clients can ask for a delta
+const MAX_LIBRARY_VERSIONS = 5;
+const libraryVersions = new Map();
+let currentLibrary = null;
+
+function buildLibraryVersion(tracks, etag, lastModified) {
+    // Serialize each track once; the strings double as change detectors
+    const trackJson = new Map();
+    for (const track of tracks) {
+        trackJson.set(track.id, JSON.stringify(track));
+    }
+    return { etag, lastModified, body: JSON.stringify(tracks), trackJson };
+}
+
+function loadLibrary() {
     // Check if library.json exists for fallback
     const libraryPath = path.join(__dirname, 'library.json');
-    if (fs.existsSync(libraryPath)) {
+    let stat = null;
+    try {
+        stat = fs.statSync(libraryPath);
+    } catch (e) {
+        stat = null;
+    }
+
+    const etag = stat ? `"${stat.size.toString(16)}-${Math.floor(stat.mtimeMs).toString(16)}"` : '"mock"';
+    if (currentLibrary && currentLibrary.etag === etag) {
+        return currentLibrary;
+    }
+
+    let tracks = mockLibrary;
+    let lastModified = new Date(0).toUTCString();
+    if (stat) {
         try {
-            const library = JSON.parse(fs.readFileSync(libraryPath, 'utf8'));
-            res.json(library);
-            return;
+            tracks = JSON.parse(fs.readFileSync(libraryPath, 'utf8'));
+            lastModified = stat.mtime.toUTCString();
         } catch (e) {
             console.error('Error reading library.json:', e);
+            return currentLibrary || buildLibraryVersion(mockLibrary, '"mock"', lastModified);
+        }
+    }
+
+    currentLibrary = buildLibraryVersion(tracks, etag, lastModified);
+    libraryVersions.set(etag, currentLibrary);
+    while (libraryVersions.size > MAX_LIBRARY_VERSIONS) {
+        libraryVersions.delete(libraryVersions.keys().next().value);
+    }
+    return currentLibrary;
+}
+
+function setValidators(res, library) {
+    res.set('ETag', library.etag);
+    res.set('Last-Modified', library.lastModified);
+    res.set('Cache-Control', 'no-cache');
+}
+
+// API endpoint for music library
+app.get('/api/music', (req, res) => {
+    const library = loadLibrary();
+    setValidators(res, library);
+    if (req.fresh) {
+        res.status(304).end();
+        return;
+    }
+    res.type('application/json').send(library.body);
+});
+
+// Changes since an earlier library version: { etag, changed: [...], removed: [ids] }
+app.get('/api/music/delta', (req, res) => {
+    const library = loadLibrary();
+    setValidators(res, library);
+    if (req.query.since === library.etag) {
+        res.status(304).end();
+        return;
+    }
+
+    const base = libraryVersions.get(req.query.since);
+    if (!base) {
+        res.status(410).json({ error: 'Unknown base version, fetch /api/music instead' });
+        return;
+    }
+
+    const changed = [];
+    const removed = [];
+    for (const [id, json] of library.trackJson) {
+        if (base.trackJson.get(id) !== json) {
+            changed.push(json);
         }
     }
-    
-    // Default mock library if nothing else exists
-    const mockLibrary = [
-        {
-            id: 'track_001',
-            title: 'Example Song',
-            artist: 'Example Artist',
-            album: 'Example Album',
-            duration: '180',
-            url: 'http://localhost:3000/music/example.mp3',
-            file_path: '/music/example.mp3',
-            genre: 'Example',
-            year: '2023'
+    for (const id of base.trackJson.keys()) {
+        if (!library.trackJson.has(id)) {
+            removed.push(id);
         }
-    ];
-    
-    res.json(mockLibrary);
+    }
+    res.type('application/json').send(
+        `{"etag":${JSON.stringify(library.etag)},"changed":[${changed.join(',')}],"removed":${JSON.stringify(removed)}}`
+    );
 });
 
 // Endpoint to set/get server configuration
@@ -69,5 +150,6 @@ app.post('/api/config', (req, res) => {
 app.listen(PORT, () => {
     console.log(`🎵 Music server running at http://localhost:${PORT}`);
     console.log(`📚 API endpoint: http://localhost:${PORT}/api/music`);
+    console.log(`🔄 Delta endpoint: http://localhost:${PORT}/api/music/delta?since=<etag>`);
     console.log(`⚙️  Config endpoint: http://localhost:${PORT}/api/config`);
 });
\ No newline at end of file
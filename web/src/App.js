@@ -9,6 +9,9 @@ function App() {
   const [nowPlaying, setNowPlaying] = useState(null);
   const [queue, setQueue] = useState([]);
   const [library, setLibrary] = useState([]);
+  const [libraryTotal, setLibraryTotal] = useState(0);
+  const [libraryCursor, setLibraryCursor] = useState(null);
+  const [librarySort, setLibrarySort] = useState('title');
   const [playlists, setPlaylists] = useState([]);
   const [isPlaying, setIsPlaying] = useState(false);
   const [volume, setVolume] = useState(100);
@@ -18,14 +21,37 @@ function App() {
   const [directUrl, setDirectUrl] = useState('');
   const [serverUrl, setServerUrl] = useState('http://localhost:3000');
 
-  // Load data from API
-  useEffect(() => {
-    // Load library
-    fetch('http://localhost:5000/api/library')
+  // Load one page of the library, sorted on the server
+  const loadLibraryPage = (sort, cursor = null) => {
+    const params = new URLSearchParams({
+      limit: 100,
+      sort,
+      fields: 'id,title,artist,album,duration',
+    });
+    if (cursor) params.set('cursor', cursor);
+    
+    fetch(`http://localhost:5000/api/library?${params}`)
       .then(res => res.json())
-      .then(data => setLibrary(data))
+      .then(data => {
+        if (data.error) {
+          // A stale cursor means the library changed: reload from the top
+          if (cursor && data.generation !== undefined) loadLibraryPage(sort);
+          else console.error('Library load error:', data.error);
+          return;
+        }
+        setLibrary(prev => (cursor ? [...prev, ...data.tracks] : data.tracks));
+        setLibraryTotal(data.total);
+        setLibraryCursor(data.next_cursor);
+      })
       .catch(err => console.error('Library load error:', err));
-    
+  };
+
+  useEffect(() => {
+    loadLibraryPage(librarySort);
+  }, [librarySort]);
+
+  // Load data from API
+  useEffect(() => {
     // Load server URL
     fetch('http://localhost:5000/api/server')
       .then(res => res.json())
@@ -159,7 +185,11 @@ function App() {
           volume={volume}
           loopMode={loopMode}
           onControlAction={handleControlAction}
-          onVolumeChange={(vol) => handleControlAction('volume', { volume: vol })}
+          onVolumeChange={(vol) => {
+            // Volume applies live on the bot, so move the slider right away
+            setVolume(vol);
+            handleControlAction('volume', { volume: vol });
+          }}
           onLoopChange={(mode) => handleControlAction('loop', { mode })}
         />
         
@@ -167,6 +197,11 @@ function App() {
           {activeTab === 'library' && (
             <LibraryBrowser 
               library={library}
+              total={libraryTotal}
+              sortBy={librarySort}
+              onSortChange={setLibrarySort}
+              hasMore={Boolean(libraryCursor)}
+              onLoadMore={() => loadLibraryPage(librarySort, libraryCursor)}
               onPlayTrack={(track) => handleControlAction('play', { track_id: track.id })}
             />
           )}
@@ -1,8 +1,7 @@
 import React, { useState } from 'react';
 
-const LibraryBrowser = ({ library, onPlayTrack }) => {
+const LibraryBrowser = ({ library, total, sortBy, onSortChange, hasMore, onLoadMore, onPlayTrack }) => {
   const [searchQuery, setSearchQuery] = useState('');
-  const [sortBy, setSortBy] = useState('title');
 
   const filteredLibrary = library.filter(track => 
     !searchQuery || 
@@ -11,16 +10,8 @@ const LibraryBrowser = ({ library, onPlayTrack }) => {
     track.album.toLowerCase().includes(searchQuery.toLowerCase())
   );
 
-  const sortedLibrary = [...filteredLibrary].sort((a, b) => {
-    if (sortBy === 'title') {
-      return a.title.localeCompare(b.title);
-    } else if (sortBy === 'artist') {
-      return a.artist.localeCompare(b.artist);
-    } else if (sortBy === 'album') {
-      return a.album.localeCompare(b.album);
-    }
-    return 0;
-  });
+  // Pages arrive already sorted by the server
+  const sortedLibrary = filteredLibrary;
 
   const formatDuration = (seconds) => {
     if (!seconds) return '0:00';
@@ -49,18 +40,20 @@ const LibraryBrowser = ({ library, onPlayTrack }) => {
             <label>Sort by:</label>
             <select 
               value={sortBy} 
-              onChange={(e) => setSortBy(e.target.value)}
+              onChange={(e) => onSortChange(e.target.value)}
               className="sort-select"
             >
               <option value="title">Title</option>
               <option value="artist">Artist</option>
               <option value="album">Album</option>
+              <option value="year">Year</option>
+              <option value="duration">Duration</option>
             </select>
           </div>
         </div>
         
         <div className="library-stats">
-          <span>{library.length} tracks available</span>
+          <span>{total} tracks available ({library.length} loaded)</span>
         </div>
       </div>
       
@@ -87,6 +80,12 @@ const LibraryBrowser = ({ library, onPlayTrack }) => {
           </div>
         ))}
       </div>
+      
+      {hasMore && (
+        <button className="btn-primary load-more-btn" onClick={onLoadMore}>
+          Load more
+        </button>
+      )}
     </div>
   );
 };